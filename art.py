@@ -0,0 +1,293 @@
+# -*- coding: utf-8 -*-
+"""
+album art loading
+
+Cover images are looked up next to the played file (cover.jpg, folder.png,
+...) or embedded in it (ID3v2 APIC frames, FLAC PICTURE blocks). A worker
+thread decodes and scales them, so the render loop only has to pick up the
+finished thumbnails. Thumbnails are kept in a size-bounded in-memory cache
+and a size-bounded on-disk cache, both keyed by album.
+"""
+
+import os, struct, hashlib, threading, Queue, cStringIO, collections
+import pygame
+
+NAMES = ('cover', 'folder', 'front', 'album', 'albumart')
+EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+def key(tag, file):
+  """
+  key(tag, file) -> cache key of the album a track belongs to
+
+  Tracks without album tag are grouped by directory.
+  """
+  if tag.get('album'):
+    return '%s\0%s' % (tag.get('albumartist') or tag.get('artist', ''),
+      tag['album'])
+  return os.path.dirname(file)
+
+def find_file(file):
+  """
+  find_file(file) -> path of a cover image in the directory of file or None
+  """
+  directory = os.path.dirname(file)
+  try:
+    entries = os.listdir(directory)
+  except OSError:
+    return None
+  candidates = {}
+  for entry in entries:
+    name, ext = os.path.splitext(entry.lower())
+    if name in NAMES and ext in EXTENSIONS:
+      candidates[name] = entry
+  for name in NAMES:
+    if name in candidates:
+      return os.path.join(directory, candidates[name])
+  return None
+
+def _id3_size(data, syncsafe):
+  if syncsafe:
+    b = [ord(c) for c in data]
+    return b[0] << 21 | b[1] << 14 | b[2] << 7 | b[3]
+  return struct.unpack('>L', data)[0]
+
+def _apic(frame):
+  encoding = ord(frame[0])
+  mime_end = frame.index('\0', 1)
+  # skip picture type, then the description
+  terminator = '\0\0' if encoding in (1, 2) else '\0'
+  pos = mime_end + 2
+  while True:
+    pos = frame.index(terminator, pos)
+    if len(terminator) == 1 or (pos - mime_end) % 2 == 0:
+      break
+    pos += 1
+  return frame[pos+len(terminator):]
+
+def embedded_id3(fd):
+  header = fd.read(10)
+  if len(header) < 10 or header[0:3] != 'ID3' or ord(header[3]) not in (3, 4):
+    return None
+  version = ord(header[3])
+  tag = fd.read(_id3_size(header[6:10], True))
+  pos = 0
+  while pos + 10 <= len(tag) and tag[pos] != '\0':
+    size = _id3_size(tag[pos+4:pos+8], version == 4)
+    if tag[pos:pos+4] == 'APIC':
+      try:
+        return _apic(tag[pos+10:pos+10+size])
+      except (ValueError, IndexError):
+        return None
+    pos += 10 + size
+  return None
+
+def embedded_flac(fd):
+  if fd.read(4) != 'fLaC':
+    return None
+  last = False
+  while not last:
+    header = fd.read(4)
+    if len(header) < 4:
+      return None
+    last = ord(header[0]) & 0x80
+    length = struct.unpack('>L', '\0' + header[1:4])[0]
+    if ord(header[0]) & 0x7f != 6:
+      fd.seek(length, 1)
+      continue
+    block = fd.read(length)
+    pos = 4
+    # skip MIME type and description
+    for field in (0, 1):
+      pos += 4 + struct.unpack('>L', block[pos:pos+4])[0]
+    pos += 16
+    size = struct.unpack('>L', block[pos:pos+4])[0]
+    return block[pos+4:pos+4+size]
+  return None
+
+def embedded(file):
+  """
+  embedded(file) -> image data embedded in file or None
+  """
+  try:
+    fd = open(file, 'rb')
+  except IOError:
+    return None
+  try:
+    for reader in (embedded_id3, embedded_flac):
+      fd.seek(0)
+      try:
+        data = reader(fd)
+      except (struct.error, IOError):
+        data = None
+      if data:
+        return data
+  finally:
+    fd.close()
+  return None
+
+def scale(image, size):
+  """
+  scale(image, size) -> image scaled to fit into a size x size square,
+  centered on a transparent background
+  """
+  width, height = image.get_size()
+  factor = float(size) / max(width, height)
+  scaled = (max(1, int(width * factor)), max(1, int(height * factor)))
+  try:
+    image = pygame.transform.smoothscale(image, scaled)
+  except ValueError:
+    # smoothscale only handles 24 and 32 bit surfaces
+    image = pygame.transform.scale(image, scaled)
+  surface = pygame.Surface((size, size), pygame.SRCALPHA, 32)
+  surface.fill((0, 0, 0, 0))
+  surface.blit(image, ((size - scaled[0]) / 2, (size - scaled[1]) / 2))
+  return surface
+
+class Loader:
+  """
+  Loader(size, [cachedir, [memory, [disk, [notify]]]]) -- asynchronous cover loader
+
+  Cover thumbnails of size x size pixels are loaded in a background thread.
+  request() and poll() must both be called from the render thread; the
+  in-memory cache is only touched there and needs no locking. memory and
+  disk are the cache limits in bytes. notify is called from the loader
+  thread whenever a result is ready.
+  """
+  def __init__(self, size, cachedir = None, memory = 16 << 20, disk = 64 << 20,
+               notify = None):
+    self.size = size
+    self.notify = notify
+    self.cachedir = cachedir or os.path.join(
+      os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))),
+      'cmus-fullscreen', 'art')
+    self.memory = memory
+    self.disk = disk
+    self._memory = collections.OrderedDict()
+    self._used = 0
+    self._wanted = None
+    self._pending = set()
+    self._prefetch = set()
+    self._requests = Queue.Queue()
+    self._results = Queue.Queue()
+    self._thread = threading.Thread(target=self._work, name='art')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def request(self, key, file, prefetch = False):
+    """
+    Loader.request(key, file, [prefetch]) -> (True, surface) if cached,
+                                              (False, None) else
+
+    Returns the cover of the album key from the memory cache. Otherwise
+    queues loading it for file; the result is returned by a later poll().
+    surface is None if the album has no cover. Prefetch requests only fill
+    the cache and don't replace the album currently wanted.
+    """
+    if not prefetch:
+      self._wanted = key
+    if key in self._memory:
+      image = self._memory.pop(key)
+      self._memory[key] = image
+      return True, image
+    if prefetch:
+      self._prefetch.add(key)
+    if key not in self._pending:
+      self._pending.add(key)
+      self._requests.put((key, file))
+    return False, None
+
+  def poll(self):
+    """
+    Loader.poll() -> list of (key, surface) loaded since the last call
+    """
+    results = []
+    while True:
+      try:
+        key, image = self._results.get_nowait()
+      except Queue.Empty:
+        return results
+      self._pending.discard(key)
+      self._prefetch.discard(key)
+      if image is False:
+        continue
+      if image is not None:
+        image = image.convert_alpha()
+      self._remember(key, image)
+      results.append((key, image))
+
+  def stop(self):
+    self._requests.put(None)
+
+  def _remember(self, key, image):
+    if key in self._memory:
+      return
+    self._memory[key] = image
+    self._used += self._bytes(image)
+    while self._used > self.memory and len(self._memory) > 1:
+      self._used -= self._bytes(self._memory.popitem(False)[1])
+
+  def _bytes(self, image):
+    if image is None:
+      return 0
+    return image.get_pitch() * image.get_height()
+
+  def _path(self, key):
+    ext = '.png' if pygame.image.get_extended() else '.tga'
+    return os.path.join(self.cachedir,
+      '%s-%d%s' % (hashlib.sha1(key).hexdigest(), self.size, ext))
+
+  def _work(self):
+    while True:
+      job = self._requests.get()
+      if job is None:
+        return
+      key, file = job
+      if key != self._wanted and key not in self._prefetch:
+        # skipped track, don't bother
+        self._results.put((key, False))
+        continue
+      try:
+        image = self._load(key, file)
+      except (pygame.error, IOError, OSError):
+        image = None
+      self._results.put((key, image))
+      if self.notify:
+        self.notify()
+
+  def _load(self, key, file):
+    path = self._path(key)
+    if os.path.exists(path):
+      os.utime(path, None)
+      return pygame.image.load(path)
+    cover = find_file(file)
+    if cover:
+      image = pygame.image.load(cover)
+    else:
+      data = embedded(file)
+      if not data:
+        return None
+      image = pygame.image.load(cStringIO.StringIO(data), 'cover.jpg')
+    image = scale(image, self.size)
+    self._store(path, image)
+    return image
+
+  def _store(self, path, image):
+    try:
+      if not os.path.isdir(self.cachedir):
+        os.makedirs(self.cachedir)
+      pygame.image.save(image, path)
+      files = [os.path.join(self.cachedir, f) for f in os.listdir(self.cachedir)]
+      files = [(os.stat(f).st_mtime, os.path.getsize(f), f) for f in files]
+    except (OSError, IOError, pygame.error):
+      return
+    used = sum([f[1] for f in files])
+    files.sort()
+    while used > self.disk and files:
+      mtime, size, f = files.pop(0)
+      try:
+        os.unlink(f)
+      except OSError:
+        pass
+      used -= size
+
+# vim: set sw=2 et
@@ -6,14 +6,23 @@ the cmus-remote -Q command in a nicer form.
 
 NOT THREAD-SAFE!'''
 
-import os, socket, struct, mmap
+import os, time, socket, struct, mmap, marshal, tempfile, codecs
 
 _sock = False
 
-def Socket():
+def Socket(private = False):
+    '''
+    returns a socket connected to cmus. All callers share one connection,
+    unless private is True; then a new connection is returned, e.g. for use
+    in another thread.
+    '''
     global _sock
     # TODO: read socket path from config and use IP if desired
     # TODO: reopen if connection was closed
+    if private:
+        sock = socket.socket(socket.AF_UNIX)
+        sock.connect(os.path.expanduser(os.path.join('~', '.cmus', 'socket')))
+        return sock
     if not _sock:
         try:
             _sock = socket.socket(socket.AF_UNIX)
@@ -23,14 +32,48 @@ def Socket():
             raise
     return _sock
 
+def enabled(value):
+    '''
+    returns whether a setting of a Status is on. Settings reported as true or
+    false are bools, others keep their value, like shuffle in newer cmus
+    versions (off, tracks or albums); of these, only off means off.
+    '''
+    return value not in (None, False, 'off')
+
 class Status(dict):
     '''
     returns a dict containing all information returned by the status command in
     cmus. The dict contains two sub-dicts 'tag' and 'set' containing the file
     metadata and the cmus settings.
+
+    cmus reports the position in whole seconds. elapsed() extrapolates it
+    from the time of the last update, so the status only has to be updated
+    every few seconds. Each update that continues playback refines the
+    estimate to the part of the second cmus reported.
+
+    update() returns what changed; callbacks for single fields can be
+    registered with subscribe().
+
+    private is passed on to Socket(), for a Status used in another thread.
+
+    Numbers are decoded to ints, settings reported as true or false to
+    bools; other settings keep their value, see enabled(). Most lines of a
+    reply are the same as in the previous one, so parsed lines are cached
+    per instance and a steady-state update only looks them up; a reply equal
+    to the previous one isn't even parsed.
     '''
-    def __init__(self):
-        self._sock = Socket()
+    _integers = frozenset(['duration', 'position', 'tracknumber',
+                           'vol_left', 'vol_right'])
+    _booleans = {'true': True, 'false': False}
+    # limit of the number of cached parsed lines
+    _parsed_max = 512
+
+    def __init__(self, private = False):
+        self._private = private
+        self._sock = Socket(private)
+        self._subscribers = {}
+        self._parsed = {}
+        self._reply = None
         self.update()
 
     def _receive(self, retry = True):
@@ -39,45 +82,328 @@ class Status(dict):
             return self._sock.recv(4096)
         except socket.error:
             if retry:
-                self._sock = Socket()
+                self._sock = Socket(self._private)
                 return self._receive(False)
             else:
                 return ""
 
+    def elapsed(self, now = None):
+        '''
+        returns the playback position in seconds as a float, extrapolated
+        from the last update while playing
+        '''
+        if 'position' not in self:
+            return 0.0
+        position = self._position
+        if self['status'] == 'playing':
+            position += (now or time.time()) - self.updated
+        if self.get('duration', 0) > 0:
+            position = min(position, self['duration'])
+        return position
+
+    def ended(self, now = None):
+        '''
+        returns True if the extrapolated position reached the end of the track
+        '''
+        return self['status'] == 'playing' and self.get('duration', 0) > 0 \
+           and self.elapsed(now) >= self['duration']
+
+    def subscribe(self, field, callback):
+        '''
+        calls callback(status, value) after every update which changed field
+        (a key of the diff returned by update()) to value
+        '''
+        self._subscribers.setdefault(field, []).append(callback)
+
+    def _parse(self, line):
+        '''
+        returns (section, key, value) for a line of a status reply, or None
+        if it holds no field
+        '''
+        if line == '':
+            return None
+        splitted = line.split(" ", 1)
+        try:
+            if splitted[0] in ('tag', 'set'):
+                section = splitted[0]
+                key, value = splitted[1].split(" ", 1)
+            else:
+                section = None
+                key, value = splitted
+            value = value.strip()
+            if section and value == '':
+                return None
+            if key in self._integers:
+                value = int(value)
+            elif section == 'set':
+                value = self._booleans.get(value, value)
+            return section, intern(key), value
+        except (IndexError, ValueError):
+            print line
+            return None
+
+    def _fields(self, reply):
+        '''yields (section, key, value) for every line of a status reply'''
+        parsed = self._parsed
+        for line in reply.split("\n"):
+            try:
+                field = parsed[line]
+            except KeyError:
+                field = self._parse(line)
+                # positions hardly ever repeat
+                if not field or field[1] != 'position':
+                    if len(parsed) >= self._parsed_max:
+                        parsed.clear()
+                    parsed[line] = field
+            if field:
+                yield field
+
+    def _assign(self, fields):
+        '''
+        stores (section, key, value) triples, section being None, 'tag' or
+        'set', in place of the previous fields and returns the changes
+        '''
+        changes = {}
+        sections = {
+            None: self,
+            'tag': self.setdefault('tag', {}),
+            'set': self.setdefault('set', {}),
+        }
+        seen = {None: set(['tag', 'set']), 'tag': set(), 'set': set()}
+
+        def store(section, key, value):
+            seen[section].add(key)
+            target = sections[section]
+            if key not in target or target[key] != value:
+                target[key] = value
+                if section:
+                    changes.setdefault(section, {})[key] = value
+                else:
+                    changes[key] = value
+
+        for section, key, value in fields:
+            store(section, key, value)
+        if 'status' not in seen[None]:
+            store(None, 'status', 'stopped')
+        settings = sections['set']
+        if 'vol_left' in seen['set'] and 'vol_right' in seen['set']:
+            changed = changes.get('set', ())
+            if 'vol' not in settings or 'vol_left' in changed \
+               or 'vol_right' in changed:
+                store('set', 'vol', (settings['vol_left'] + settings['vol_right']) / 2)
+            else:
+                seen['set'].add('vol')
+        for section, target in sections.items():
+            if len(target) == len(seen[section]):
+                continue
+            for key in [k for k in target if k not in seen[section]]:
+                del target[key]
+                if section:
+                    changes.setdefault(section, {})[key] = None
+                else:
+                    changes[key] = None
+        return changes
+
+    def _notify(self, changes):
+        for field, value in changes.iteritems():
+            for callback in self._subscribers.get(field, ()):
+                callback(self, value)
+
     def update(self):
-        dict.__init__(self)
-        self['status'] = 'stopped'
-        self['tag'] = {}
-        self['set'] = {}
-        p = self._receive().split("\n")
-        for line in p:
-            if not line == '':
-                splitted = line.split(" ", 1)
-                try:
-                    if splitted[0] in ('tag', 'set'):
-                        splitted[1:] = splitted[1].split(" ", 1)
-                        if splitted[2].strip() != '':
-                            self[splitted[0]][splitted[1]] = splitted[2].strip()
-                    else:
-                        self[splitted[0]] = splitted[1].strip()
-                except IndexError:
-                    print line
-        if 'duration' in self.keys():
-            self['duration'] = int(self['duration'])
-        if 'position' in self.keys():
-            self['position'] = int(self['position'])
-        if 'tracknumber' in self['tag'].keys():
-            self['tag']['tracknumber'] = int(self['tag']['tracknumber'])
-        if 'vol_left' in self['set'].keys():
-            self['set']['vol_left'] = int(self['set']['vol_left'])
-        if 'vol_right' in self['set'].keys():
-            self['set']['vol_right'] = int(self['set']['vol_right'])
-        if 'vol_left' in self['set'].keys() and 'vol_right' in self['set'].keys():
-            self['set']['vol'] = (self['set']['vol_left']+self['set']['vol_right'])/2
+        '''
+        queries cmus and returns the changed fields as a dict mapping them to
+        their new values (None if the field is gone). For tags and settings,
+        only the changed ones are listed in a dict under 'tag' and 'set'.
+        '''
+        now = time.time()
+        guess = self.elapsed(now) if 'position' in self else None
+        previous = self.get('file')
+        reply = self._receive()
+        if reply == self._reply:
+            # polled within the same second: nothing can have changed
+            changes = {}
+        else:
+            self._reply = reply
+            changes = self._assign(self._fields(reply))
+        if 'position' in self:
+            position = self['position']
+            if guess is not None and self.get('file') == previous \
+               and abs(guess - position) < 2:
+                # same playback, keep the estimate within the reported second
+                self._position = min(max(guess, position), position + 0.999)
+            else:
+                self._position = float(position)
+        self.updated = now
+        self._notify(changes)
+        return changes
+
+def _feed_path():
+    directory = os.environ.get('XDG_RUNTIME_DIR')
+    if not directory:
+        directory = '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+    return os.path.join(directory, 'cmus-fullscreen-status-%d' % os.getuid())
+
+class Feed:
+    '''
+    a memory-mapped file through which one writer hands a string to any
+    number of readers on the same host.
+
+    The segment starts with a magic string, a sequence number and the length
+    of the data. The writer makes the sequence number odd while it changes
+    the data and even again when it is done (a seqlock), so readers never
+    lock and just retry if the number was odd or changed while they copied
+    the data.
+    '''
+    _magic = 'CFS\x01'
+    _header = struct.Struct('<4sLL')
+
+    def __init__(self, path = None, writer = False, size = 1 << 16):
+        self.path = path or _feed_path()
+        self.writer = writer
+        self.size = size
+        self._map = None
+        self.seq = 0
+        if writer:
+            fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0600)
+            try:
+                if os.fstat(fd).st_size != size:
+                    os.ftruncate(fd, size)
+                self._map = mmap.mmap(fd, size)
+            finally:
+                os.close(fd)
+            if self._map[0:4] == self._magic:
+                # keep counting, readers may still have the segment mapped
+                self.seq = (self._seq() + 1) & ~1
+            else:
+                self._map[0:self._header.size] = self._header.pack(self._magic, 0, 0)
+
+    def _open(self):
+        try:
+            fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            return False
+        try:
+            self._map = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+        except (mmap.error, ValueError):
+            return False
+        finally:
+            os.close(fd)
+        if self._map[0:4] != self._magic:
+            self._map = None
+            return False
+        return True
+
+    def _seq(self):
+        return struct.unpack('<L', self._map[4:8])[0]
+
+    def publish(self, data):
+        '''
+        replaces the data in the segment, returns False if it is too large
+        '''
+        m = self._map
+        start = self._header.size
+        if start + len(data) > self.size:
+            return False
+        self.seq += 1
+        m[4:8] = struct.pack('<L', self.seq)
+        m[start:start+len(data)] = data
+        m[8:12] = struct.pack('<L', len(data))
+        self.seq += 1
+        m[4:8] = struct.pack('<L', self.seq)
+        return True
+
+    def read(self, tries = 100):
+        '''
+        returns the sequence number and the data in the segment, or None if
+        there is no data or the writer kept changing it
+        '''
+        if self._map is None and not self._open():
+            return None
+        m = self._map
+        start = self._header.size
+        for i in xrange(tries):
+            seq = self._seq()
+            if seq & 1:
+                time.sleep(0)
+                continue
+            length = struct.unpack('<L', m[8:12])[0]
+            data = m[start:start+length]
+            if self._seq() == seq:
+                return (seq, data) if length else None
+        return None
+
+    def close(self):
+        if self._map is not None:
+            self._map.close()
+            self._map = None
+
+class Broker(Status):
+    '''
+    a Status which publishes every update to a Feed, so SharedStatus
+    instances on the same host don't have to query cmus themselves.
+    '''
+    def __init__(self, path = None):
+        self._feed = Feed(path, True)
+        Status.__init__(self)
+
+    def update(self):
+        changes = Status.update(self)
+        self._feed.publish(marshal.dumps(
+            (dict(self), getattr(self, '_position', 0.0), self.updated)))
+        return changes
+
+class SharedStatus(Status):
+    '''
+    a Status read from the Feed of a Broker. Reading it costs no socket
+    round-trip; if the data didn't change since the last update, it isn't
+    even decoded. If no broker published anything for timeout seconds, the
+    status is queried from cmus directly, over a connection of its own if
+    private is True.
+    '''
+    def __init__(self, path = None, timeout = 5.0, private = False):
+        self._feed = Feed(path)
+        self._private = private
+        self._sock = None
+        self._subscribers = {}
+        self._parsed = {}
+        self._reply = None
+        self._seq = None
+        self.timeout = timeout
+        self.update()
+
+    def update(self):
+        now = time.time()
+        record = self._feed.read()
+        if record is not None and record[0] == self._seq \
+           and now - self.updated < self.timeout:
+            return {}
+        if record is not None:
+            status, position, updated = marshal.loads(record[1])
+            if now - updated < self.timeout:
+                self._seq = record[0]
+                self._reply = None
+                changes = self._assign(self._shared_fields(status))
+                self._position = position
+                self.updated = updated
+                self._notify(changes)
+                return changes
+        self._seq = None
+        if self._sock is None:
+            self._sock = Socket(self._private)
+        return Status.update(self)
+
+    def _shared_fields(self, status):
+        for key, value in status.iteritems():
+            if key in ('tag', 'set'):
+                for k, v in value.iteritems():
+                    yield key, k, v
+            else:
+                yield None, key, value
 
 class Control:
-    def __init__(self):
-        self._sock = Socket()
+    def __init__(self, private = False):
+        self._private = private
+        self._sock = Socket(private)
 
     def _send(self, text, retry = True):
         try:
@@ -86,11 +412,32 @@ class Control:
             return True
         except socket.error:
             if retry:
-                self._sock = Socket()
+                self._sock = Socket(self._private)
                 return self._send(text, False)
             else:
                 return False
 
+    def query(self, text, retry = True):
+        '''
+        sends a command and returns its output. cmus terminates every reply
+        with an empty line, which is stripped.
+        '''
+        try:
+            self._sock.sendall("%s\n" % text)
+            buf = self._sock.recv(4096)
+            while buf and buf != '\n' and not buf.endswith('\n\n'):
+                data = self._sock.recv(4096)
+                if not data:
+                    break
+                buf += data
+            return buf[:-1]
+        except socket.error:
+            if retry:
+                self._sock = Socket(self._private)
+                return self.query(text, False)
+            else:
+                return ''
+
     def pause(self):
         return self._send('player-pause')
 
@@ -143,40 +490,79 @@ class Control:
     def raw(self, text):
         return self._send(text)
 
+    def upcoming(self, status):
+        '''
+        returns the path of the file cmus will play after the one in status
+        (a Status or a dict with 'file' and 'set'), or None if that can't be
+        told: the queue comes first, then the playlist unless shuffled. The
+        order of the library view isn't known.
+        '''
+        queued = self.query('save -q -').split('\n')
+        if queued[0] != '':
+            return queued[0]
+        settings = status['set']
+        if settings.get('play_library') is not False \
+           or enabled(settings.get('shuffle')) \
+           or enabled(settings.get('repeat_current')) \
+           or 'file' not in status:
+            return None
+        playlist = [line for line in self.query('save -p -').split('\n') if line != '']
+        try:
+            i = playlist.index(status['file'])
+        except ValueError:
+            return None
+        if i + 1 < len(playlist):
+            return playlist[i + 1]
+        if enabled(settings.get('repeat')):
+            return playlist[0]
+        return None
+
 class Cache:
-    _cache = False
-    _cache_index = {}
-    def __init__(self):
+    '''
+    Read-only access to the cmus track cache (~/.cmus/cache).
+
+    Iterating over a Cache yields one dict per record. Lookups by path
+    (cache[path]) go through an index mapping paths to record offsets, which
+    is stored next to the cache and only rebuilt when the cache's mtime
+    changes. Thus, a lookup decodes a single record instead of the whole file.
+    '''
+    _index_version = 1
+
+    def __init__(self, path = None):
         self.structsize = struct.calcsize('3l')
+        self._path = path or os.path.expanduser(os.path.join('~', '.cmus', 'cache'))
+        self._cache = False
+        self._index = None
+        self._offset = 8
+        self.endloc = 0
+        self.mtime = None
         self._open()
 
     def __iter__(self):
+        self._offset = 8
         return self
 
-    def _getfield(self, fd):
-        buf = fd.read(1)
-        while buf[-1] != '\0':
-            buf += fd.read(1)
-        return buf[:-1]
-
     def keys(self):
-        return self._cache_index.keys()
+        return self._get_index().keys()
+
+    def __contains__(self, file):
+        return file in self._get_index()
 
     def _open(self):
-        if not self._cache:
+        try:
+            fd = open(self._path, 'rb')
             try:
-                self._cache = open(os.path.expanduser(os.path.join('~', '.cmus', 'cache')))
-            except IOError:
-                def next():
-                    raise StopIteration
-                self.next = next
-                return False
-        self._cache.seek(0, 2)
-        self.endloc = self._cache.tell()
-        self._cache.seek(0)
-        if self._cache.read(4) != 'CTC\x01':
-            raise Exception('unexpected cache magic string: %s' % buf)
-        flags = struct.unpack('<l', self._cache.read(4))[0]
+                self._cache = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+                self.mtime = os.fstat(fd.fileno()).st_mtime
+            finally:
+                fd.close()
+        except (IOError, OSError, ValueError):
+            # missing or empty cache: behave like an empty one
+            return False
+        self.endloc = len(self._cache)
+        if self._cache[0:4] != 'CTC\x01':
+            raise Exception('unexpected cache magic string: %r' % self._cache[0:4])
+        flags = struct.unpack('<l', self._cache[4:8])[0]
         if flags & 0x01:
             self._64bit = True
             self._bytelength = 7
@@ -187,21 +573,37 @@ class Cache:
             self._big_endian = True
         else:
             self._big_endian = False
-        self._cache.seek(8)
-
-    def next(self):
-        offset = self._cache.tell()
-        if offset >= self.endloc:
-            raise StopIteration
-
-        s = struct.unpack('3l', self._cache.read(self.structsize))
+        return True
+
+    def changed(self):
+        '''
+        returns True if the cache file was rewritten since it was opened, by
+        the same mtime and size check which decides whether the index is
+        current
+        '''
+        try:
+            stat = os.stat(self._path)
+        except OSError:
+            return self._cache is not False
+        return stat.st_mtime != self.mtime or stat.st_size != self.endloc
+
+    def _skip(self, offset, size):
+        return offset + ((size + self._bytelength) & ~self._bytelength)
+
+    def _read(self, offset):
+        '''returns the record at offset and the offset of the following one'''
+        c = self._cache
+        s = struct.unpack('3l', c[offset:offset+self.structsize])
+        end = offset + s[0]
+        start = offset + self.structsize
+        nul = c.find('\0', start, end)
         entry = {
                 'size': s[0],
                 'duration': s[1],
                 'mtime': s[2],
-                'file': self._getfield(self._cache)
+                'file': c[start:nul]
         }
-        fields = self._cache.read(entry['size']-self.structsize-len(entry['file'])-1).split('\0')
+        fields = c[nul+1:end].split('\0')
         for i in xrange(0, len(fields)-1, 2):
             if fields[i] == 'tracknumber':
                 try:
@@ -209,36 +611,148 @@ class Cache:
                 except ValueError:
                     fields[i+1] = 0
             entry[fields[i]] = fields[i+1]
-        seeker = ((entry['size'] + self._bytelength) & ~self._bytelength) - entry['size']
-        if seeker > 0:
-            try:
-                self._cache.seek(seeker, 1)
-            except ValueError:
-                self._cache.seek(self.endloc)
-        del seeker
+        return entry, self._skip(offset, s[0])
+
+    def next(self):
+        if self._offset >= self.endloc:
+            raise StopIteration
+        entry, self._offset = self._read(self._offset)
         return entry
 
     def gen_index(self):
-        self._cache_index = {}
-        for track in self:
-            self._cache_index[track['file']] = track
-
+        '''
+        builds the path -> offset index by reading only the record headers
+        and file names, then stores it next to the cache
+        '''
+        index = {}
+        c = self._cache
+        sizelen = struct.calcsize('l')
+        offset = 8
+        while offset < self.endloc:
+            size = struct.unpack('l', c[offset:offset+sizelen])[0]
+            if size <= 0:
+                break
+            start = offset + self.structsize
+            index[c[start:c.find('\0', start, offset + size)]] = offset
+            offset = self._skip(offset, size)
+        self._index = index
+        try:
+            tmp = self._index_path() + '.tmp'
+            fd = open(tmp, 'wb')
+            marshal.dump((self._index_version, self.mtime, self.endloc, index), fd)
+            fd.close()
+            os.rename(tmp, self._index_path())
+        except (IOError, OSError):
+            pass
+        return index
+
+    def _index_path(self):
+        return self._path + '-fullscreen.idx'
+
+    def _load_index(self):
+        try:
+            fd = open(self._index_path(), 'rb')
+            try:
+                version, mtime, size, index = marshal.load(fd)
+            finally:
+                fd.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError):
+            return None
+        if version != self._index_version or mtime != self.mtime \
+           or size != self.endloc:
+            return None
+        return index
+
+    def _get_index(self):
+        if self._index is None:
+            if not self._cache:
+                self._index = {}
+            else:
+                self._index = self._load_index()
+                if self._index is None:
+                    self.gen_index()
+        return self._index
 
     def __getitem__(self, file):
-        if not self._cache_index:
-            self.gen_index()
-        if file in self._cache_index.keys():
-            return self._cache_index[file]
-        else:
+        offset = self._get_index().get(file)
+        if offset is None:
             return False
+        return self._read(offset)[0]
 
     def __setitem__(self, key, value):
         raise NotImplementedError
 
+def _list_path(directory, line):
+    line = line.rstrip('\r')
+    if line and not line.startswith('/') and '://' not in line:
+        return os.path.join(directory, line)
+    return line
+
+def read_list(path, size = 1 << 16):
+    '''
+    yields the paths in a cmus file list (lib.pl, a playlist or the queue)
+    one at a time, reading the file in chunks of size bytes. Paths are byte
+    strings like in the cache. Byte order marks and CRLF line endings are
+    handled; UTF-16 lists are converted to UTF-8 like the paths in the cache,
+    whatever the locale, and relative paths are taken relative to the list's
+    directory.
+    '''
+    directory = os.path.dirname(path)
+    fd = open(path, 'rb')
+    try:
+        decoder = None
+        rest = ''
+        data = fd.read(size)
+        if data.startswith(codecs.BOM_UTF8):
+            data = data[len(codecs.BOM_UTF8):]
+        elif data[:2] in (codecs.BOM_UTF16_LE, codecs.BOM_UTF16_BE):
+            decoder = codecs.getincrementaldecoder('utf-16')()
+        while data:
+            if decoder:
+                data = decoder.decode(data).encode('utf-8')
+            lines = (rest + data).split('\n')
+            rest = lines.pop()
+            for line in lines:
+                line = _list_path(directory, line)
+                if line:
+                    yield line
+            data = fd.read(size)
+        if decoder:
+            rest += decoder.decode('', True).encode('utf-8')
+        rest = _list_path(directory, rest)
+        if rest:
+            yield rest
+    finally:
+        fd.close()
+
 def library():
-    fd = open(os.path.expanduser(os.path.join('~', '.cmus', 'lib.pl')))
-    return [line[0:-1] for line in fd]
+    '''
+    returns the set of all paths in the library (~/.cmus/lib.pl)
+    '''
+    return set(read_list(os.path.expanduser(os.path.join('~', '.cmus', 'lib.pl'))))
 
 Library = library
 
+def playlists():
+    '''
+    returns a dict mapping the names of the cmus playlists to their files:
+    the named playlists in ~/.cmus/playlists, the single playlist of older
+    cmus versions as "playlist" and the queue as "[queue]"
+    '''
+    base = os.path.expanduser(os.path.join('~', '.cmus'))
+    lists = {}
+    directory = os.path.join(base, 'playlists')
+    try:
+        for name in os.listdir(directory):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path):
+                lists[name] = path
+    except OSError:
+        pass
+    for name, filename in (('playlist', 'playlist.pl'), ('[queue]', 'queue.pl')):
+        path = os.path.join(base, filename)
+        if name not in lists and os.path.isfile(path):
+            lists[name] = path
+    return lists
+
 # vim: set sw=4 et
@@ -6,90 +6,141 @@ Fullscreen music title display
 This app provides a fullscreen interface to cmus, including library navigation.
 """
 
-import pygame, sys, os, time, operator, socket
-import cmus, shapes
+import pygame, sys, os, re, time, operator, socket, locale, threading, Queue
+import subprocess
+import cmus, shapes, search, libtree, art, remote, gpu, watch, tags, web
 
 try:
   import dbus
-  import thread, Queue
-  import pylirc
 except ImportError:
-  # TODO: implement library reading without threads
   pass
 
 DEBUG = 0
 SCRIPT_START = time.time()
 
-def LibThread(q):
+class Future:
   """
-  LibThread(q) -- Get representation of cmus' cache
+  Future() -- result of a computation in another thread
 
-  On success, puts a dict representing cmus' cache in the Queue object q.
+  The computing thread calls set_result() or set_exception() once.
+  """
+  def __init__(self):
+    self._done = threading.Event()
+    self._result = None
+    self._error = None
+
+  def set_result(self, result):
+    self._result = result
+    self._done.set()
+
+  def set_exception(self, error):
+    self._error = error
+    self._done.set()
 
-  This function is intended to be called as a separate thread! Thus, it
-  does few error handling and modifies nice value.
+  def done(self):
+    return self._done.is_set()
+
+  def result(self, timeout = None):
+    """
+    Future.result([timeout]) -> result, raises the exception of the
+    computation instead if there was one
+    """
+    self._done.wait(timeout)
+    if self._error is not None:
+      raise self._error
+    return self._result
+
+class LibraryWorker:
   """
-  os.nice(1)
-  time.sleep(0)
-  library = cmus.library()
-  cache = cmus.Cache()
-  liblist = {}
-  # BUG: newly added tracks don't appear in the listing as they aren't recorded
-  #      neither in the cache nor in the library.pl
-  # TODO: report progress values, maybe even return partial results?
-  for track in cache:
-    # allow other thread to jump in
-    time.sleep(0)
-    try:
-      q.get_nowait()
-      q.task_done()
-      return False
-    except Queue.Empty:
-      pass
+  LibraryWorker([notify]) -- read the library tree in the background
+
+  Builds a dict representing cmus' cache, restricted to the files in the
+  library, and sets it as the result of the worker's future. The paths of
+  library files which aren't in the cache are in its '__missing__' set.
+  If reading fails, the future holds the exception; if the worker was
+  cancelled, its result is None. Cancellation is checked once per batch of
+  tracks, after which the worker sleeps delay seconds. notify is called from
+  the worker thread when it is done.
+  """
+  batch = 256
+  delay = 0.0
 
+  def __init__(self, notify = None):
+    self.notify = notify
+    self.cancelled = threading.Event()
+    self.future = Future()
+    self._thread = threading.Thread(target=self._work, name='library')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def cancel(self):
+    self.cancelled.set()
+
+  def join(self, timeout = None):
+    self._thread.join(timeout)
+
+  def _work(self):
+    os.nice(1)
     try:
-        del library[library.index(track['file'])]
-    except ValueError:
+      self.future.set_result(self.build())
+    except Exception, e:
+      # a broken cache mustn't leave the future unresolved
+      self.future.set_exception(e)
+    if self.notify:
+      self.notify()
+
+  def build(self):
+    library = cmus.library()
+    cache = cmus.Cache()
+    liblist = libtree.new_level()
+    # TODO: report progress values, maybe even return partial results?
+    for i, track in enumerate(cache):
+      if i % self.batch == 0:
+        if self.cancelled.is_set():
+          return None
+        # allow other threads to jump in
+        time.sleep(self.delay)
+      if track['file'] not in library:
         # file is in cache but not in library
         continue
+      library.discard(track['file'])
+      libtree.add_track(liblist, track)
 
-    # use dummy values if no value given
-    artist = track['albumartist'] if track.has_key('albumartist') and track['albumartist'] != '' \
-             else track['artist'] if track.has_key('artist') and track['artist'] != '' \
-             else '[unknown]'
-
-    album = track['album'] if track.has_key('album') and track['album'] != '' \
-            else '[unknown]'
-
-    title = track['title'] if track.has_key('title') and track['title'] != '' \
-            else os.path.basename(track['file']).rsplit('.', 1)[0]
+    # the tags of these are read by a tags.Tagger
+    liblist['__missing__'] = library
 
-    if not liblist.has_key(artist):
-      liblist[artist] = {}
-    if not liblist[artist].has_key(album):
-      liblist[artist][album] = {}
-    liblist[artist][album][title] = track
+    if self.cancelled.is_set():
+      return None
+    liblist['__index__'] = search.Index(liblist)
+    return liblist
 
-  # TODO: get files not in cache manually
-  #       (hint: library contains their paths now)
+class PlaylistWorker(LibraryWorker):
+  """
+  PlaylistWorker(path, [notify]) -- read a playlist in the background
 
-  def sorter(x):
-    ref = liblist[artist][album][x]
-    if ref.has_key('tracknumber') and ref['tracknumber'] != 0:
-      return ref['tracknumber']
-    elif ref.has_key('title') and ref['title'] != '':
-      return ref['title']
-    else:
-      return 0
+  Like LibraryWorker, but builds a tree of the tracks of the playlist file
+  at path which are in the cmus cache.
+  """
+  def __init__(self, path, notify = None):
+    self.path = path
+    LibraryWorker.__init__(self, notify)
 
-  for artist in liblist.keys():
-    for album in liblist[artist].keys():
-      # sort by tracknumber if existant, title else
-      liblist[artist][album]['__keys__'] = \
-        sorted(liblist[artist][album].keys(), key=sorter)
-    liblist[artist]['__keys__'] = sorted(liblist[artist].keys(), key=str.lower)
-  liblist['__keys__'] = sorted(liblist.keys(), key=str.lower)
-  q.put(liblist)
+  def build(self):
+    tree = libtree.new_level()
+    cache = cmus.Cache()
+    try:
+      for i, path in enumerate(cmus.read_list(self.path)):
+        if i % self.batch == 0:
+          if self.cancelled.is_set():
+            return None
+          time.sleep(self.delay)
+        track = cache[path]
+        if track:
+          libtree.add_track(tree, track)
+    except IOError:
+      pass
+    tree['__index__'] = search.Index(tree)
+    return tree
 
 class Surface(pygame.Surface):
   """
@@ -105,9 +156,296 @@ class Surface(pygame.Surface):
     # need to be updated
     self.updates.append(pygame.Rect(rect))
 
-  def blit(self, source, dest, area = None, blank = True):
+  def blit(self, source, dest, area = None, blank = True, special_flags = 0):
     self.update((dest, area[2:4]) if area else (dest, source.get_size()), blank)
-    pygame.Surface.blit(self, source, dest, area)
+    pygame.Surface.blit(self, source, dest, area, special_flags)
+
+
+class Scheduler:
+  """
+  Scheduler([frame_rate, [idle_rate, [input_latency]]]) -- frame pacing
+
+  Every frame, the widgets register the time they next change with at().
+  wait() then sleeps until the earliest of these deadlines, or until an
+  event arrives, but no longer than 1/idle_rate seconds. Deadlines never
+  lead to more than frame_rate frames per second. Input which has to be
+  polled (polling = True) is checked at least every input_latency seconds.
+
+  Wakeups per minute and the time from picking up a key press to the next
+  display update are measured and printed in DEBUG mode.
+  """
+  WAKEUP = pygame.USEREVENT
+
+  def __init__(self, frame_rate = 30, idle_rate = 1.0, input_latency = 0.05):
+    self.frame_rate = frame_rate
+    self.idle_rate = idle_rate
+    self.input_latency = input_latency
+    self.polling = False
+    self.deadlines = {}
+    self.last_frame = 0
+    self.key_time = None
+    self.latencies = []
+    self.minute = time.time()
+    self.wakeups = 0
+    self.idle_wakeups = 0
+    self.drawn = False
+
+  def at(self, name, when):
+    """
+    Scheduler.at(name, when) -- have the loop run at time when for name
+    """
+    self.deadlines[name] = when
+
+  def wait(self):
+    """
+    Scheduler.wait() -- sleep until the next deadline or event
+    """
+    now = time.time()
+    self.count(now)
+    deadline = min(self.deadlines.values() + [now + 1.0 / self.idle_rate])
+    deadline = max(deadline, self.last_frame + 1.0 / self.frame_rate)
+    if self.polling:
+      deadline = min(deadline, now + self.input_latency)
+    # the widgets register again in the next frame
+    self.deadlines = {}
+    timeout = int((deadline - now) * 1000)
+    if pygame.event.peek():
+      # don't reorder pending events by waiting for (and re-posting) one
+      if pygame.event.peek(pygame.KEYDOWN) and self.key_time is None:
+        self.key_time = time.time()
+    elif timeout > 0:
+      pygame.time.set_timer(self.WAKEUP, timeout)
+      event = pygame.event.wait()
+      pygame.time.set_timer(self.WAKEUP, 0)
+      if event.type != self.WAKEUP:
+        pygame.event.post(event)
+        if event.type == pygame.KEYDOWN:
+          self.key_time = time.time()
+    self.last_frame = time.time()
+    self.drawn = False
+
+  def draw(self):
+    """
+    Scheduler.draw() -- note that the display was updated
+    """
+    self.drawn = True
+    if self.key_time is not None:
+      self.latencies.append(time.time() - self.key_time)
+      self.key_time = None
+      if DEBUG:
+        print 'scheduler  key to pixel: %f' % self.latencies[-1]
+
+  def count(self, now):
+    self.wakeups += 1
+    if not self.drawn:
+      self.idle_wakeups += 1
+    if now - self.minute >= 60:
+      if DEBUG:
+        print 'scheduler   wakeups/min: %d (%d idle)' % (
+          self.wakeups * 60 / (now - self.minute), self.idle_wakeups * 60 / (now - self.minute))
+      self.minute = now
+      self.wakeups = self.idle_wakeups = 0
+
+class Governor:
+  """
+  Governor([budget, [factor, [patience, [recovery, [headroom]]]]]) -- adapt
+  to the load
+
+  measure() is told how long every frame took and what kind of frame it was,
+  None for frames the levels can't make cheaper. The usual cost of each kind
+  is a moving average of its frames at level 0 while nothing else ran. A
+  frame is over budget if it took longer than factor times that, and longer
+  than budget seconds. After patience frames in a row over budget, the level
+  rises by one, up to levels; once no frame took more than headroom times
+  its budget for recovery seconds, it falls by one again. Level 0 is full
+  quality, the Screen decides what the higher levels leave out.
+
+  Changes of the level are printed in DEBUG mode.
+  """
+  levels = 2
+  # weight of a frame in the moving average of its kind
+  smoothing = 0.1
+
+  def __init__(self, budget = 0.1, factor = 2.0, patience = 3,
+    recovery = 1.0, headroom = 0.5):
+    self.budget = budget
+    self.factor = factor
+    self.patience = patience
+    self.recovery = recovery
+    self.headroom = headroom
+    self.level = 0
+    self.over = 0
+    self.calm = time.time()
+    self.usual = {}
+
+  def limit(self, kind = None):
+    """
+    Governor.limit([kind]) -> seconds a frame of kind may take
+    """
+    return max(self.budget, self.factor * self.usual.get(kind, 0))
+
+  def measure(self, duration, kind = None, idle = False, now = None):
+    """
+    Governor.measure(duration, [kind, [idle, [now]]]) -> True if the level
+    changed
+
+    idle tells whether nothing else ran during the frame, which makes it a
+    sample of the usual cost of its kind.
+    """
+    now = now or time.time()
+    level = self.level
+    limit = self.limit(kind)
+    if kind is not None and idle and self.level == 0:
+      usual = self.usual.get(kind, duration)
+      self.usual[kind] = usual + (duration - usual) * self.smoothing
+    if kind is not None and duration > limit:
+      self.over += 1
+      if self.over >= self.patience and self.level < self.levels:
+        self.level += 1
+        self.over = 0
+    elif kind is not None:
+      self.over = 0
+    if duration > limit * self.headroom:
+      self.calm = now
+    elif self.level > 0 and now - self.calm >= self.recovery:
+      self.level -= 1
+      self.calm = now
+    if self.level == level:
+      return False
+    if DEBUG:
+      print 'governor          level: %d (%s frame took %f, budget %f)' % (
+        self.level, kind, duration, limit)
+    return True
+
+def wakeup():
+  """
+  wakeup() -- wake up the render loop, e.g. from another thread
+  """
+  try:
+    pygame.event.post(pygame.event.Event(Scheduler.WAKEUP))
+  except pygame.error:
+    pass
+
+class Prefetcher:
+  """
+  Prefetcher([notify]) -- find out which track cmus plays next
+
+  Asks cmus for the upcoming track in a background thread, over a
+  connection of its own, and looks up its metadata in the cmus cache, which
+  is reopened whenever cmus has rewritten it. notify is called from that
+  thread whenever a result is ready.
+  """
+  def __init__(self, notify = None):
+    self.notify = notify
+    self._requests = Queue.Queue()
+    self._results = Queue.Queue()
+    self._thread = threading.Thread(target=self._work, name='prefetch')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def request(self, status):
+    """
+    Prefetcher.request(status) -- look up the track following status
+    """
+    request = {'set': dict(status['set'])}
+    if 'file' in status:
+      request['file'] = status['file']
+    self._requests.put(request)
+
+  def poll(self):
+    """
+    Prefetcher.poll() -> cache entry of the upcoming track or None
+    """
+    track = None
+    while True:
+      try:
+        track = self._results.get_nowait()
+      except Queue.Empty:
+        return track
+
+  def stop(self):
+    self._requests.put(None)
+
+  def _work(self):
+    try:
+      control = cmus.Control(True)
+      cache = cmus.Cache()
+    except Exception:
+      # without cmus or its cache, there is nothing to prefetch
+      return
+    while True:
+      status = self._requests.get()
+      if status is None:
+        return
+      file = control.upcoming(status)
+      try:
+        if cache.changed():
+          cache = cmus.Cache()
+        track = cache[file] if file else False
+      except Exception:
+        # a cache cmus is still writing; the next request tries again
+        track = False
+      if track:
+        self._results.put(track)
+        if self.notify:
+          self.notify()
+
+class StatusWatcher:
+  """
+  StatusWatcher(interval, [notify]) -- notice status changes in the background
+
+  Updates a status of its own every interval seconds in a background thread,
+  from the feed of a broker if one runs, otherwise from cmus over a
+  connection of its own. changed() returns True once after playback state,
+  track, tags or settings (like the volume) changed, and notify is called
+  from that thread, so the render loop can update its status right away
+  instead of at its next poll.
+  """
+  fields = ('status', 'file', 'duration', 'tag', 'set')
+
+  def __init__(self, interval, notify = None):
+    self.interval = interval
+    self.notify = notify
+    self._stopped = False
+    self._changes = Queue.Queue()
+    self._thread = threading.Thread(target=self._work, name='status')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def changed(self):
+    """
+    StatusWatcher.changed() -> True if the status changed since the last call
+    """
+    changed = False
+    while True:
+      try:
+        self._changes.get_nowait()
+      except Queue.Empty:
+        return changed
+      changed = True
+
+  def stop(self):
+    self._stopped = True
+
+  def _changed(self, status, value):
+    self._changes.put(True)
+    if self.notify:
+      self.notify()
+
+  def _work(self):
+    try:
+      status = cmus.SharedStatus(private = True)
+    except Exception:
+      return
+    for field in self.fields:
+      status.subscribe(field, self._changed)
+    while not self._stopped:
+      time.sleep(self.interval)
+      try:
+        status.update()
+      except Exception:
+        # cmus went away; the render loop notices that itself
+        return
 
 
 def load_font(fontname, fontsize):
@@ -133,7 +471,7 @@ def load_font(fontname, fontsize):
     if fontname+'.ttf' in files:
       return pygame.font.Font(os.path.join(root, fontname+'.ttf'), fontsize)
   # search in working dir
-  if os.exists('./'+fontname+'.ttf'):
+  if os.path.exists('./'+fontname+'.ttf'):
     return pygame.font.Font(fontname+'.ttf', fontsize)
   # last resort: return default font
   return pygame.font.Font(None, fontsize)
@@ -176,6 +514,29 @@ def load_svg(filename, size):
   f.seek(0)
   return pygame.image.load(f, 'temp.png').convert_alpha()
 
+_xrandr = re.compile(r' connected (?:primary )?(\d+)x(\d+)\+(\d+)\+(\d+)')
+
+def outputs():
+  """
+  outputs() -> list of pygame.Rect, one per monitor
+
+  With pygame 2, SDL knows the monitors and the display is opened on one of
+  them, so all Rects start at (0, 0). With pygame 1, a fullscreen display
+  spans all monitors and their geometry within it is read from xrandr. The
+  list is empty if the geometry is unknown.
+  """
+  if hasattr(pygame.display, 'get_desktop_sizes'):
+    return [pygame.Rect((0, 0), size)
+      for size in pygame.display.get_desktop_sizes()]
+  try:
+    with open(os.devnull, 'w') as null:
+      output = subprocess.Popen(['xrandr', '--current'],
+        stdout=subprocess.PIPE, stderr=null).communicate()[0]
+  except OSError:
+    return []
+  return [pygame.Rect(int(x), int(y), int(w), int(h))
+    for w, h, x, y in _xrandr.findall(output)]
+
 class Screen:
   """
   main interface class
@@ -191,6 +552,47 @@ class Screen:
   ]
   mode = 'status'
   fullscreen = True
+  search = None
+  # key repeat delay and interval in ms, and acceleration of held keys
+  key_repeat = (400, 40)
+  hold_gap = 0.25
+  hold_delay = 0.6
+  hold_rate = 0.5
+  hold_max = 32
+  held = None
+  # seconds between status queries, the progress bar is extrapolated; changes
+  # of the playback state, track or settings are looked for in the background
+  # every status_watch seconds
+  status_interval = 2.0
+  status_watch = 0.5
+  # composite the layers as textures if pygame 2 is available
+  accelerated = True
+  # number of the monitor used in fullscreen mode, None for the largest one
+  monitor = None
+  # 8 bit background, colorkey layers and RLE shapes instead of alpha layers
+  low_memory = False
+  # browser panel, and its opaque color in low_memory mode, where black is
+  # the colorkey of the layers
+  panel = (0, 0, 0, 150)
+  low_memory_panel = (20, 20, 20)
+  # serve the status as JSON over HTTP on this port, None to disable
+  http_port = None
+  http_address = ''
+  # seconds the position may differ from the published one before it is
+  # published again, e.g. after seeking
+  seek_threshold = 1.5
+  # tracks read by the tagger which are added to the library per frame
+  tag_batch = 200
+  # frame pacing, see Scheduler
+  frame_rate = 30
+  idle_rate = 1.0
+  input_latency = 0.05
+  # seconds a frame may take before the quality is lowered, at least, and
+  # the multiple of its usual cost, see Governor; under load, the library
+  # worker sleeps worker_delay seconds per batch and level
+  frame_budget = 0.1
+  frame_factor = 2.0
+  worker_delay = 0.005
 
   def __init__(self, fullscreen = True, size = None):
     """
@@ -200,23 +602,27 @@ class Screen:
     specified size.
     """
     checkpoint('first')
+    # the renderer and its window go first, while the video subsystem which
+    # created them is still untouched
+    if getattr(self, 'gpu', None):
+      self.gpu.close()
+    self.gpu = None
     pygame.font.init()
     pygame.display.init()
     pygame.event.set_allowed(None)
-    pygame.event.set_allowed((pygame.QUIT, pygame.KEYDOWN))
+    pygame.event.set_allowed((pygame.QUIT, pygame.KEYDOWN, pygame.KEYUP,
+      Scheduler.WAKEUP))
     pygame.event.set_grab(False)
+    pygame.key.set_repeat(*self.key_repeat)
     pygame.mouse.set_visible(False)
     self.fullscreen = fullscreen
-    if size:
-      self.rsize = size
+    self.display = 0
+    if size or not fullscreen:
+      self.rsize = size or (800, 600)
+      self.output = pygame.Rect((0, 0), self.rsize)
     else:
-      self.rsize = pygame.display.list_modes()[0] if fullscreen else (800, 600)
-
-    # TODO: generalize detection of dualhead configs
-    if self.rsize == (2704, 1050):
-      self.size = (1680, 1050)
-    else:
-      self.size = self.rsize
+      self.display, self.rsize, self.output = self.pick_output()
+    self.size = self.output.size
 
     checkpoint('pygame init')
 
@@ -228,45 +634,200 @@ class Screen:
     self.load_fonts()
     self.load_shapes()
     self.deactivate_screensaver()
-    if not hasattr(self, 'lircsock') and 'pylirc' in sys.modules:
-      self.lircsock = pylirc.init('cmus-fullscreen')
+    if not hasattr(self, 'scheduler'):
+      self.scheduler = Scheduler(self.frame_rate, self.idle_rate,
+        self.input_latency)
+    if not hasattr(self, 'input'):
+      self.input = remote.Input(wakeup)
+    if not hasattr(self, 'watcher'):
+      base = os.path.expanduser(os.path.join('~', '.cmus'))
+      self.watcher = watch.Watcher(
+        [os.path.join(base, 'cache'), os.path.join(base, 'lib.pl')],
+        notify = wakeup)
+      self.library_stale = False
+    if not hasattr(self, 'tagger'):
+      self.tagger = tags.Tagger(notify = wakeup)
+      self.index_stale = False
+      self.indexing = None
     pygame.display.set_caption('cmus fullscreen interface')
     # TODO: set window icon?
-    self.screen = pygame.display.set_mode(self.rsize, \
-      pygame.FULLSCREEN if fullscreen else 0)
+    if self.accelerated and not self.low_memory:
+      self.gpu = gpu.create('cmus fullscreen interface', self.rsize, fullscreen,
+        display = self.display)
+    if self.gpu:
+      self.screen = self.gpu
+    elif self.display:
+      self.screen = pygame.display.set_mode(self.rsize, \
+        pygame.FULLSCREEN if fullscreen else 0, 0, self.display)
+    else:
+      self.screen = pygame.display.set_mode(self.rsize, \
+        pygame.FULLSCREEN if fullscreen else 0)
     checkpoint('window')
+    if hasattr(self, 'art'):
+      self.art.stop()
+    self.art = art.Loader(self.size[1]/2,
+      memory = (4 << 20) if self.low_memory else (16 << 20), notify = wakeup)
+    self.art_key = None
+    self.back_changed = False
     self.back = self.draw_background()
-    # TODO: only make browsurf as big as needed
-    self.browsurf = Surface(self.size, pygame.SRCALPHA)
-    self.surf = Surface(self.size, pygame.SRCALPHA)
+    if not hasattr(self, 'prefetcher'):
+      self.prefetcher = Prefetcher(wakeup)
+    if not hasattr(self, 'status_watcher'):
+      self.status_watcher = StatusWatcher(self.status_watch, wakeup)
+    self.prefetched = None
+    self.progress = (None, None, None)
+    self.minute = None
+    # the browser panel covers the left third of the screen
+    self.browsurf = self.new_layer((self.size[0]/3+70, self.size[1]-30), Surface)
+    self.surf = self.new_layer(self.size, Surface)
+    self.report_memory()
     try:
-      self.st = cmus.Status()
+      self.st = cmus.SharedStatus()
     except:
       # TODO: print this onscreen and retry
       raise Exception('cmus not started')
-    self.start_thread()
+    if not hasattr(self, 'web'):
+      self.web = None
+      if self.http_port is not None:
+        try:
+          self.web = web.Server(self.http_port, self.http_address)
+        except socket.error, e:
+          print 'HTTP server not started:', e
+    if self.web:
+      self.publish_status()
+    if not hasattr(self, 'governor'):
+      self.governor = Governor(self.frame_budget, self.frame_factor)
+      self.antialias = True
+      self.settings_pending = False
+    self.start_worker()
     self.first = True
 
-  def start_thread(self):
-    if not hasattr(self, 'thread'):
-      try:
-        self.queue = Queue.Queue()
-        self.thread = thread.start_new_thread(LibThread, (self.queue, ))
-      except NameError:
-        self.thread = True
-        self.queue = 0
+  def new_layer(self, size, cls = pygame.Surface):
+    """
+    Screen.new_layer(size, [cls]) -> transparent surface of class cls
+
+    Layers have per-pixel alpha; in low_memory mode, they have the display
+    format and black as colorkey instead. They are drawn to every frame, so
+    unlike the static shapes, they aren't RLE accelerated: every change
+    would have them encoded again.
+    """
+    if self.low_memory:
+      layer = cls(size, 0, self.screen)
+      layer.set_colorkey((0, 0, 0))
+    else:
+      layer = cls(size, pygame.SRCALPHA)
+    layer.fill((0, 0, 0, 0))
+    return layer
+
+  def opaque(self, color):
+    """
+    Screen.opaque(color) -> color which is drawn onto the layers
+
+    In low_memory mode, black is replaced by the closest color which isn't
+    the colorkey.
+    """
+    if self.low_memory and tuple(color[:3]) == (0, 0, 0):
+      return (1, 1, 1)
+    return color
+
+  def report_memory(self):
+    """
+    Screen.report_memory() -- print the memory used by all surfaces
+
+    Only prints if the global variable DEBUG is nonzero.
+    """
+    if not DEBUG:
+      return
+    surfaces = [('back', self.back), ('surf', self.surf),
+      ('browsurf', self.browsurf)]
+    if not self.gpu:
+      surfaces.append(('screen', self.screen))
+    surfaces += sorted([('shape ' + name, shape)
+      for name, shape in self.shapes.items() if name != 'musicimg'])
+    total = 0
+    for name, surface in surfaces:
+      size = surface.get_pitch() * surface.get_height()
+      total += size
+      print 'memory %19s: %9d bytes, %2d bit%s' % (name, size,
+        surface.get_bitsize(),
+        ' RLE' if surface.get_flags() & pygame.RLEACCELOK else '')
+    print 'memory %19s: %9d bytes' % ('total', total)
+
+  def pick_output(self):
+    """
+    Screen.pick_output() -> (display, rsize, output)
+
+    Chooses the monitor to use in fullscreen mode. Returns the SDL display
+    to open, the size of the display surface and the Rect of the monitor
+    within it.
+    """
+    monitors = outputs()
+    if hasattr(pygame.display, 'get_desktop_sizes'):
+      rsize = None
+    else:
+      rsize = pygame.display.list_modes()[0]
+      bounds = pygame.Rect((0, 0), rsize)
+      monitors = [m for m in monitors if bounds.contains(m)]
+      if not monitors:
+        return 0, rsize, bounds
+    if self.monitor is not None and 0 <= self.monitor < len(monitors):
+      display = self.monitor
+    else:
+      areas = [m.width * m.height for m in monitors]
+      display = areas.index(max(areas))
+    output = monitors[display]
+    if rsize is None:
+      return display, output.size, output
+    return 0, rsize, output
+
+  def start_worker(self):
+    if not hasattr(self, 'worker'):
+      self.worker = LibraryWorker(wakeup)
+      self.unavailable = 0
+      self.playlist_worker = None
+      self.apply_quality()
+
+  def apply_quality(self):
+    """
+    Screen.apply_quality() -- follow the quality level of the governor
+
+    From level 1 on, the library workers sleep after smaller batches, so
+    they take less of the CPU, and the clock and settings are only redrawn
+    once the level is back to 0. Level 2 renders text without antialiasing;
+    all of it is redrawn afterwards.
+    """
+    level = self.governor.level
+    antialias = level < 2
+    if antialias and not self.antialias:
+      self.first = True
+    self.antialias = antialias
+    for worker in (self.worker, self.playlist_worker):
+      if worker:
+        worker.batch = LibraryWorker.batch if level == 0 \
+          else LibraryWorker.batch / 8
+        worker.delay = self.worker_delay * level
 
   def quit(self):
     """
     Screen.quit() -- close all components
     """
+    self.watcher.close()
+    self.tagger.stop()
+    self.art.stop()
+    self.prefetcher.stop()
+    self.status_watcher.stop()
+    # SDL objects must be destroyed before their subsystem is shut down
+    if self.gpu:
+      self.gpu.close()
     pygame.display.quit()
     os.unlink(os.path.expanduser(os.path.join('~', '.cmus', 'inhibit-osd')))
-    if hasattr(self, 'lircsock'):
-      pylirc.exit()
-    if self.thread and self.queue:
-      self.queue.put('quit', False)
-      self.queue.join()
+    self.input.close()
+    if self.web:
+      self.web.close()
+    for worker in (self.worker, self.playlist_worker):
+      if worker:
+        worker.cancel()
+        worker.join(1.0)
     self.activate_screensaver()
 
   def load_fonts(self):
@@ -320,24 +881,41 @@ class Screen:
     except (NameError, AttributeError):
       pass
 
-  def draw_background(self):
+  def draw_background(self, cover = None):
     """
-    Screen.draw_background() -> pygame.Surface
+    Screen.draw_background([cover]) -> pygame.Surface
 
-    Paint the background layer onto a pygame surface and return it.
+    Paint the background layer onto a pygame surface and return it. cover
+    is the album art of the current track; without one, a music note icon
+    is shown instead.
     """
-    back = pygame.Surface(self.size)
     width, height = self.size
-    self.shapes['gradient'] = shapes.gen_gradient(
-      (width, height / 2),
-      self.colors[3],
-      self.colors[4]
-    )
+    palette = None
+    if self.low_memory:
+      palette = shapes.gen_palette(self.colors[3], self.colors[4])
+      back = pygame.Surface(self.size, 0, 8)
+      back.set_palette(palette)
+    else:
+      back = pygame.Surface(self.size)
+    if 'gradient' not in self.shapes \
+      or self.shapes['gradient'].get_size() != (width, height / 2) \
+      or (self.shapes['gradient'].get_bitsize() == 8) != self.low_memory:
+        self.shapes['gradient'] = shapes.gen_gradient(
+          (width, height / 2),
+          self.colors[3],
+          self.colors[4],
+          palette
+        )
+        if not palette:
+          # store it in the display format, so it is only converted once
+          self.shapes['gradient'] = self.shapes['gradient'].convert()
     back.blit(self.shapes['gradient'], (0, height - self.sh('gradient')))
 
-    # TODO: Don't use static path/icon
-    image = '/usr/share/icons/Tango/scalable/mimetypes/audio-x-generic.svg'
-    self.shapes['musicimg'] = load_svg(image, [height/2]*2)
+    if 'noart' not in self.shapes \
+      or self.shapes['noart'].get_height() != height / 2:
+        image = '/usr/share/icons/Tango/scalable/mimetypes/audio-x-generic.svg'
+        self.shapes['noart'] = load_svg(image, [height/2]*2)
+    self.shapes['musicimg'] = cover or self.shapes['noart']
     back.blit(
       self.shapes['musicimg'],
       (width / 10, (height - self.sh('musicimg')) / 2)
@@ -351,59 +929,145 @@ class Screen:
     self.shapes['dot'] = shapes.gen_dot(16/2, self.colors[1])
     self.shapes['pause'] = shapes.gen_pause([height/10]*2, self.colors[0])
     self.shapes['stop'] = shapes.gen_stop([height/10]*2, self.colors[0])
+    if self.low_memory:
+      for name in ('bar', 'dot'):
+        self.shapes[name].set_colorkey((0, 0, 0), pygame.RLEACCEL)
 
   def sw(self, name):
     return self.shapes[name].get_width()
   def sh(self, name):
     return self.shapes[name].get_height()
 
-  def render_center(self, lines):
-    size = width, height = self.size
-    i = 0
+  def title_lines(self, tag):
+    """
+    Screen.title_lines(tag) -> list of lines for render_block()
+
+    Builds the title, artist and album lines from the tags of a track.
+    """
+    lines = []
+    lines.append({
+      'text': '%s' % tag.get('title', 'Unknown Track'),
+      'font': self.fonts[0],
+      'color': self.colors[0]
+    })
+    lines.append({
+      'text': '%s' % tag.get('artist', 'Unknown Artist'),
+      'font': self.fonts[0],
+      'color': self.colors[1]
+    })
+
+    if tag.has_key('album'):
+      lines.append({
+        'text': ('%s' % tag['album']) if not tag.has_key('tracknumber') or tag['tracknumber'] == 0 else ('%s (#%d)' % (tag['album'], tag['tracknumber'])),
+        'font': self.fonts[1],
+        'color': self.colors[1]
+      })
+    else:
+      lines.append({'text': '', 'font': self.fonts[1], 'blank': True})
+    return lines
+
+  def render_block(self, lines):
+    """
+    Screen.render_block(lines) -> (pygame.Surface, position)
+
+    Renders the lines next to the music image onto a transparent layer and
+    returns it along with the position it belongs at on Screen.surf. The
+    lines are laid out against the box covers are scaled into, so they fit
+    whichever image ends up being shown.
+    """
+    width, height = self.size
+    left = width / 10 + height / 2 + 10
     blockheight = reduce(
       operator.add,
       [a['font']['font'].get_linesize()+5 for a in lines]
     )
+    block = self.new_layer((width - left, blockheight))
     fromtop = 0
     for line in lines:
-      if line['text'] != '' or line.has_key('blank'):
-        self.surf.update((
-          width / 10 + self.sw('musicimg') + 10,
-          (height - blockheight) / 2 + fromtop,
-          width * 9 / 10 - self.sw('musicimg') - 10,
-          line['font']['font'].get_linesize()
-        ))
       if line['text'] != '':
         i = 0
         sw = width+1
-        while sw + width/10+self.sw('musicimg')+1 > width:
+        while sw > width - left:
           s = line['font']['font'].render(
             line['text'].decode('utf-8')[0:-i]+'...' if i > 0 else
             line['text'].decode('utf-8'),
-            True, line['color']
+            self.antialias, line['color']
           )
           sw, sh = s.get_size()
           i += 1
-        self.surf.blit(s, (
-          width / 10 + self.sw('musicimg') + 10,
-          (height - blockheight) / 2 + fromtop
-        ))
+        block.blit(s, (0, fromtop))
       fromtop += line['font']['font'].get_linesize()+5
-      i += 1
+    return block, (left, (height - blockheight) / 2)
+
+  def render_center(self, lines):
+    block, pos = self.render_block(lines)
+    # the area is blanked, so adding copies the block including its alpha
+    self.surf.blit(block, pos, None, True, pygame.BLEND_RGBA_ADD)
+
+  def prefetch(self):
+    """
+    Screen.prefetch() -- prepare the display of the upcoming track
+
+    Renders the text block of the track the prefetcher found, and has the art
+    loader fetch its cover, so the track change itself only needs a blit.
+    """
+    track = self.prefetcher.poll()
+    if not track:
+      return
+    self.prefetched = (track['file'], self.render_block(self.title_lines(track)))
+    self.art.request(art.key(track, track['file']), track['file'], True)
+    checkpoint('prefetch')
+
+  def show_art(self):
+    """
+    Screen.show_art() -- show the album art of the current track
+
+    Requests the cover from the art loader and picks up finished covers.
+    Decoding happens in the loader's thread, so the render loop only
+    redraws the background once the cover is ready.
+    """
+    if 'file' in self.st:
+      key = art.key(self.st['tag'], self.st['file'])
+      if key != self.art_key:
+        self.art_key = key
+        cached, cover = self.art.request(key, self.st['file'])
+        if cached:
+          self.back = self.draw_background(cover)
+          self.back_changed = True
+    for key, cover in self.art.poll():
+      if key == self.art_key:
+        self.back = self.draw_background(cover)
+        self.back_changed = True
+        checkpoint('album art')
 
   def update(self, first = False):
+    if self.back_changed:
+      first = True
+      self.back_changed = False
     if len(self.surf.updates) == 0 and not first \
       and (self.mode != 'browser' or len(self.browsurf.updates) == 0):
         return False
-    width, height = self.size
-    w, h = self.screen.get_size()
+    if self.gpu:
+      self.update_gpu(first, self.output.topleft)
+    else:
+      self.update_software(first, self.output.topleft)
+    self.surf.updates = []
+    self.browsurf.updates = []
+    self.scheduler.draw()
+    checkpoint('update')
+    return True
+
+  def update_software(self, first, offset):
+    """
+    Screen.update_software(first, offset) -- composite the layers on the CPU
+    """
     if self.screen != self.surf:
-      self.screen.blit(self.back, (w-width, h-height))
+      self.screen.blit(self.back, offset)
       checkpoint('blit back')
-      self.screen.blit(self.surf, (w-width, h-height))
+      self.screen.blit(self.surf, offset)
       checkpoint('blit')
     if self.mode == 'browser':
-      self.screen.blit(self.browsurf, (w-width, h-height))
+      self.screen.blit(self.browsurf, offset)
       checkpoint('browser blit')
 
     if first:
@@ -411,12 +1075,30 @@ class Screen:
     else:
       updates = self.surf.updates
       if self.mode == 'browser':
-        updates += self.browsurf.updates
-      updates = [u.move(w-width, h-height) for u in updates]
-      self.surf.updates = []
-      self.browsurf.updates = []
+        updates = updates + self.browsurf.updates
+      updates = [u.move(offset) for u in updates]
       pygame.display.update(updates)
-    checkpoint('update')
+
+  def update_gpu(self, first, offset):
+    """
+    Screen.update_gpu(first, offset) -- composite the layers as textures
+
+    Uploads the changed parts of the layers (all of them if first) and draws
+    the layer textures. The background is only uploaded when it changed.
+    """
+    if first:
+      self.gpu.upload('back', self.back)
+      self.gpu.upload('surf', self.surf)
+      self.gpu.upload('browser', self.browsurf)
+    else:
+      self.gpu.upload('surf', self.surf, self.surf.updates)
+      if self.mode == 'browser':
+        self.gpu.upload('browser', self.browsurf, self.browsurf.updates)
+    checkpoint('upload')
+    self.gpu.present(
+      ('back', 'surf', 'browser') if self.mode == 'browser' else ('back', 'surf'),
+      offset
+    )
 
   def start_browser(self):
     self.mode = 'browser'
@@ -440,88 +1122,120 @@ class Screen:
       pass
 
   def loop(self):
+    started = time.time()
     first = self.first
     self.first = False
-    for event in pygame.event.get():
-      if event.type == pygame.KEYDOWN and event.key == pygame.K_f:
+    # while searching in the browser, all keys go to the search prompt
+    searching = self.mode == 'browser' and self.search is not None
+    events = []
+    for event in self.input.events():
+      lirc = getattr(event, 'lirc', None)
+      if event.type == pygame.QUIT:
+        self.quit()
+        return False
+      elif lirc == 'browser':
+        if self.mode == 'browser':
+          self.quit_browser()
+        else:
+          self.start_browser()
+        first = True
+      elif lirc and self.mode != 'browser':
+        # the remote only opens the browser in status mode
+        continue
+      elif searching:
+        events.append(event)
+      elif event.key == pygame.K_f:
         self.__init__(not self.fullscreen)
         first = True
-      elif event.type == pygame.KEYDOWN and event.key == pygame.K_SPACE \
-        and self.mode != 'browser':
-          self.start_browser()
-          first = True
-      elif event.type == pygame.KEYDOWN and event.key == pygame.K_s \
-        and self.mode != 'status':
-          self.quit_browser()
-          first = True
-      elif event.type == pygame.KEYDOWN \
-        and (event.key == pygame.K_ESCAPE or event.key == pygame.K_q) \
-        or event.type == pygame.QUIT:
-          self.quit()
-          return False
+      elif event.key == pygame.K_SPACE and self.mode != 'browser':
+        self.start_browser()
+        first = True
+      elif event.key == pygame.K_s and self.mode != 'status':
+        self.quit_browser()
+        first = True
+      elif event.key == pygame.K_ESCAPE or event.key == pygame.K_q:
+        self.quit()
+        return False
       else:
-        pygame.event.post(event)
-
-    if 'pylirc' in sys.modules:
-      list = pylirc.nextcode()
-      while list != None:
-        if self.mode == 'browser':
-          e = None
-          for code in list:
-            if code == 'up':
-              e = pygame.K_UP
-            elif code == 'down':
-              e = pygame.K_DOWN
-            elif code == 'page-up':
-              e = pygame.K_PAGEUP
-            elif code == 'page-down':
-              e = pygame.K_PAGEDOWN
-            elif code == 'select':
-              e = pygame.K_SPACE
-            elif code == 'back':
-              e = pygame.K_BACKSPACE
-            elif code == 'browser':
-              self.quit_browser()
-              self.first = True
-            else:
-              continue
-            pygame.event.post(pygame.event.Event(pygame.KEYDOWN, {'key': e}))
-        else:
-          if 'browser' in list:
-            self.start_browser()
-            first = True
-        list = pylirc.nextcode()
+        events.append(event)
 
     checkpoint('events')
+    if self.refresh_library() and self.mode == 'browser':
+      first = True
+    if self.merge_tags() and self.mode == 'browser':
+      first = True
     self.loop_status(first)
+    self.show_art()
+    self.prefetch()
     if self.mode == 'browser':
-      if not self.loop_browser(first):
-        pygame.event.clear()
+      if not self.loop_browser(first, events):
         self.quit_browser()
         self.first = True
-      else:
-        pygame.event.clear()
-    else:
-      pygame.event.clear()
 
     # update screen
     self.update(first)
+    self.measure(started, first)
     return True
 
+  def measure(self, started, first):
+    """
+    Screen.measure(started, first) -- tell the governor about the frame
+
+    Only frames which updated the display, or ran along with a library
+    worker it can slow down, are made cheaper by a higher level. Full
+    redraws are a kind of their own, they cost more than the frames of
+    either mode. Frames while a worker or the tagger runs aren't idle.
+    """
+    workers = [worker for worker in (self.worker, self.playlist_worker)
+      if worker and not worker.future.done()]
+    if first:
+      kind = 'redraw'
+    elif self.scheduler.drawn or workers:
+      kind = self.mode
+    else:
+      kind = None
+    idle = not workers and not self.tagger.pending
+    if self.governor.measure(time.time() - started, kind, idle):
+      self.apply_quality()
+
+  def publish_status(self, now = None):
+    """
+    Screen.publish_status([now]) -- hand the status over to the HTTP server
+
+    Besides the fields of cmus.Status, the document holds the time of
+    publishing as updated, with the position extrapolated to it.
+    """
+    now = now or time.time()
+    status = dict(self.st)
+    if 'position' in status:
+      status['position'] = self.st.elapsed(now)
+    status['updated'] = now
+    self.web.publish(status)
+    self.published = (self.st.elapsed(now), now)
+
   def loop_status(self, first):
     width, height = size = self.size
-    old = self.st.copy()
-    self.st.update()
+    now = time.time()
+    age = now - self.st.updated
+    if self.status_watcher.changed() or first \
+      or age >= self.status_interval or age >= 0.25 and self.st.ended(now):
+        changes = self.st.update()
+    else:
+      changes = {}
     st = self.st
-
-    if not st['tag'].has_key('artist'):
-      st['tag']['artist'] = 'Unknown Artist'
-    if not st['tag'].has_key('title'):
-      st['tag']['title'] = 'Unknown Track'
+    # the position changes all the time, clients extrapolate it unless
+    # it jumped
+    if self.web and changes:
+      position, then = self.published
+      if st['status'] == 'playing':
+        position += now - then
+      if any(key != 'position' for key in changes) \
+        or abs(st.elapsed(now) - position) > self.seek_threshold:
+          self.publish_status(now)
 
     checkpoint('status update')
 
-    if st['status'] != old['status'] or first:
+    if 'status' in changes or first:
       if st['status'] == 'paused':
         self.surf.blit(self.shapes['pause'], 
           ((width - self.sw('pause')) / 2, height / 6 - self.sh('pause') / 2)
@@ -538,33 +1252,24 @@ class Screen:
           self.sh('pause')
         ))
 
-    if st['tag'] != old['tag'] or first:
-      lines = []
-      lines.append({
-        'text': '%s' % st['tag']['title'],
-        'font': self.fonts[0],
-        'color': self.colors[0]
-      })
-      lines.append({
-        'text': '%s' % st['tag']['artist'],
-        'font': self.fonts[0],
-        'color': self.colors[1]
-      })
-
-      if st['tag'].has_key('album'):
-        lines.append({
-          'text': ('%s' % st['tag']['album']) if not st['tag'].has_key('tracknumber') or st['tag']['tracknumber'] == 0 else ('%s (#%d)' % (st['tag']['album'], st['tag']['tracknumber'])),
-          'font': self.fonts[1],
-          'color': self.colors[1]
-        })
-      else:
-        lines.append({'text': '', 'font': self.fonts[1], 'blank': True})
-
+    if 'tag' in changes or first:
       checkpoint('track change')
-      self.render_center(lines)
+      if not first and self.prefetched and self.prefetched[0] == st.get('file'):
+        block, pos = self.prefetched[1]
+        self.surf.blit(block, pos, None, True, pygame.BLEND_RGBA_ADD)
+      else:
+        self.render_center(self.title_lines(st['tag']))
       checkpoint('trackinfo')
-
-    if old['set']['vol'] != st['set']['vol'] or first:
+      self.prefetched = None
+      self.prefetch_late = False
+      self.prefetcher.request(st)
+    elif not self.prefetch_late and 'position' in st and 'duration' in st \
+      and st['duration'] - st['position'] < 15:
+        # ask again shortly before the end in case the queue was changed
+        self.prefetch_late = True
+        self.prefetcher.request(st)
+
+    if 'vol' in changes.get('set', ()) or first:
       sh = self.fonts[2]['font'].metrics('%')[0][3]
       sw = sh*4
       vol = pygame.Surface((sw+3, sh+3))
@@ -586,7 +1291,7 @@ class Screen:
       vol.set_colorkey((0, 0, 0))
 
       vols = self.fonts[2]['font'].render(
-        '%02d%%' % st['set']['vol'], True, self.colors[2])
+        '%02d%%' % st['set']['vol'], self.antialias, self.colors[2])
       self.surf.blit(vols, (
         width - vols.get_width() - 10,
         height - vols.get_height() - 10
@@ -599,67 +1304,71 @@ class Screen:
       self.shapes['vols'] = vols
       checkpoint('volume')
 
-    if     st.has_key('position') \
-       and st.has_key('duration') \
-       and ( \
-            not old.has_key('position') \
-         or not old.has_key('duration') \
-         or old['position'] != st['position'] \
-         or old['duration'] != st['duration'] \
-         or first \
-        ):
+    if st.has_key('position') and st.has_key('duration'):
+      position = st.elapsed(now)
       pos = [(width - self.sw('bar')) / 2, height * 3 / 4]
-      self.surf.blit(self.shapes['bar'], pos)
-      self.surf.blit(self.shapes['dot'], (
-          pos[0] + float(st['position']) / st['duration'] * (self.sw('bar') - self.sw('dot')), pos[1]
-        ), None, False)
-      s = self.fonts[2]['font'].render(
-        '%d:%02d' % (st['duration'] / 60, st['duration'] % 60),
-        True,
-        self.colors[1]
-      )
-      self.surf.update((
-        pos[0],
-        pos[1] + self.shapes['bar'].get_height() + 3,
-        self.shapes['bar'].get_width(),
-        s.get_height()
-      ))
-      self.surf.blit(s, (
-        pos[0] + self.shapes['bar'].get_width() - s.get_width(),
-        pos[1] + self.shapes['bar'].get_height() + 3)
-      )
-      s = self.fonts[2]['font'].render(
-        '%d:%02d' % (st['position'] / 60, st['position'] % 60),
-        True,
-        self.colors[1]
-      )
-      self.surf.blit(s, (pos[0], pos[1] + self.shapes['bar'].get_height()+3))
-      del pos, s
+      dot = 0
+      if st['duration'] > 0:
+        dot = int(position / st['duration'] * (self.sw('bar') - self.sw('dot')))
+      progress = (dot, int(position), st['duration'])
+      old_progress, self.progress = self.progress, progress
+      if first or progress[0] != old_progress[0] \
+        or progress[2] != old_progress[2]:
+          self.surf.blit(self.shapes['bar'], pos)
+          self.surf.blit(self.shapes['dot'], (pos[0] + dot, pos[1]), None, False)
+      if first or progress[1:] != old_progress[1:]:
+        s = self.fonts[2]['font'].render(
+          '%d:%02d' % (st['duration'] / 60, st['duration'] % 60),
+          self.antialias,
+          self.colors[1]
+        )
+        self.surf.update((
+          pos[0],
+          pos[1] + self.shapes['bar'].get_height() + 3,
+          self.shapes['bar'].get_width(),
+          s.get_height()
+        ))
+        self.surf.blit(s, (
+          pos[0] + self.shapes['bar'].get_width() - s.get_width(),
+          pos[1] + self.shapes['bar'].get_height() + 3)
+        )
+        s = self.fonts[2]['font'].render(
+          '%d:%02d' % (progress[1] / 60, progress[1] % 60),
+          self.antialias,
+          self.colors[1]
+        )
+        self.surf.blit(s, (pos[0], pos[1] + self.shapes['bar'].get_height()+3))
+      del pos
 
       checkpoint('position')
 
-    if st['set'] != old['set'] or first:
+    # under load, the settings and the clock wait for the governor
+    relaxed = self.governor.level == 0
+    if 'set' in changes:
+      self.settings_pending = True
+    if first or relaxed and self.settings_pending:
+      self.settings_pending = False
       sstring = []
       sstring.append('Playing: %s' %
-        (st['set']['aaa_mode'] if st['set']['play_library'] == 'true'
+        (st['set']['aaa_mode'] if cmus.enabled(st['set']['play_library'])
           else 'playlist').title()
       )
 
-      if st['set']['continue'] != 'true':
+      if not cmus.enabled(st['set']['continue']):
         sstring.append('Stop after track')
       else:
-        if st['set']['repeat_current'] == 'true':
+        if cmus.enabled(st['set']['repeat_current']):
           sstring.append('Repeat current track')
         else:
-          if st['set']['repeat'] != 'true':
+          if not cmus.enabled(st['set']['repeat']):
             sstring.append('Stop after playlist')
-      if st['set']['shuffle'] == 'true':
+      if cmus.enabled(st['set']['shuffle']):
         sstring.append('Shuffle')
       sstring.reverse()
 
       s = self.fonts[2]['font'].render(
         ' – '.decode('utf-8').join(sstring),
-        True,
+        self.antialias,
         self.colors[2]
       )
       sw, sh = s.get_size()
@@ -676,10 +1385,11 @@ class Screen:
 
       checkpoint('settings')
 
-    if int(time.time()-0.25) / 60 != int(time.time()) / 60 or first:
+    if first or relaxed and int(now) / 60 != self.minute:
+      self.minute = int(now) / 60
       s = self.fonts[1]['font'].render(
         time.strftime('%H:%M'),
-        True,
+        self.antialias,
         self.colors[2]
       )
       sw, sh = s.get_size()
@@ -687,114 +1397,152 @@ class Screen:
 
       checkpoint('clock')
 
-  def loop_browser(self, first):
+    # tell the scheduler when something changes next
+    sched = self.scheduler
+    sched.at('clock', (int(now) / 60 + 1) * 60)
+    sched.at('status', st.updated + self.status_interval)
+    if st['status'] == 'playing' and st.get('duration', 0) > 0 \
+      and 'position' in st:
+        span = max(1, self.sw('bar') - self.sw('dot'))
+        position = st.elapsed(now)
+        step = min(
+          int(position) + 1,
+          float(self.progress[0] + 1) * st['duration'] / span
+        ) - position
+        sched.at('position', now + max(step, 0))
+        sched.at('end', max(now + st['duration'] - position, st.updated + 0.25))
+
+  def loop_browser(self, first, events):
     width, height = self.size
-    if hasattr(self, 'thread') and self.thread != False:
-      if isinstance(self.queue, int):
-        if first:
-          s = self.fonts[1]['font'].render(
-            'Browser unavailable.',
-            True,
-            self.colors[1]
-          )
-          self.browsurf.blit(s, (50, 50))
-          return True
-        elif self.queue < 10:
-          self.queue += 1
-          return True
-        else:
-          self.queue = 0
-          return False
-      try:
-        self.liblist = self.queue.get_nowait()
-        self.queue.task_done()
-      except Queue.Empty:
+    if not hasattr(self, 'library'):
+      if self.worker:
+        # the worker wakes us up when it is done
         if first:
           s = self.fonts[1]['font'].render(
             'Loading browser...',
-            True,
+            self.antialias,
             self.colors[1]
           )
           self.browsurf.blit(s, (50, 50))
         return True
+      if first:
+        s = self.fonts[1]['font'].render(
+          'Browser unavailable.',
+          self.antialias,
+          self.colors[1]
+        )
+        self.browsurf.blit(s, (50, 50))
+        return True
+      elif self.unavailable < 10:
+        self.unavailable += 1
+        self.scheduler.at('browser', time.time() + 0.1)
+        return True
       else:
-        self.thread = False
-        del self.queue
-        first = True
+        self.unavailable = 0
+        return False
 
     if not hasattr(self, 'control'):
       self.control = cmus.Control()
-      self.selected = {'artist': 0, 'album': -1, 'track': -1}
-      self.current = 'artist'
       checkpoint('init control')
 
-    selected = self.selected[self.current]
+    if self.playlist_worker:
+      if not self.take_playlist():
+        # the worker wakes us up when it is done
+        if first:
+          self.browsurf.update((30, 30, width/3+40, height-60))
+          s = self.fonts[1]['font'].render(
+            'Loading playlist...',
+            self.antialias,
+            self.colors[1]
+          )
+          self.browsurf.blit(s, (50, 50))
+        return True
+      first = True
+
     pp = (height - 100) / self.fonts[1]['font'].get_linesize()
-    artistlist = self.liblist['__keys__']
-    albumlist = self.liblist[artistlist[self.selected['artist']]]['__keys__'] if self.current != 'artist' else False
-    tracklist = self.liblist[artistlist[self.selected['artist']]][albumlist[self.selected['album']]]['__keys__'] if self.current == 'track' else False
-    curlist = tracklist if self.current == 'track' else albumlist if self.current == 'album' else artistlist
 
-    for event in pygame.event.get():
-      if event.type == pygame.KEYDOWN:
+    # navigation keys are summed up and applied once per frame
+    rows = pages = 0
+    for event in events:
+      if self.search is None and event.key in remote.NAVIGATION:
+        count = getattr(event, 'count', 1)
         if event.key == pygame.K_DOWN:
-          if selected < len(curlist)-1:
-            self.selected[self.current] += 1
-            first = True
-          else:
-            self.selected[self.current] = 0
-            first = True
+          rows += count * self.acceleration(event.key)
         elif event.key == pygame.K_UP:
-          if selected > 0:
-            self.selected[self.current] -= 1
-            first = True
-          else:
-            self.selected[self.current] = len(curlist)-1
-            first = True
+          rows -= count * self.acceleration(event.key)
         elif event.key == pygame.K_PAGEDOWN:
-          if selected < len(curlist)-pp:
-            self.selected[self.current] += pp
-          else:
-            self.selected[self.current] = len(curlist)-1
-          first = True
-        elif event.key == pygame.K_PAGEUP:
-          if selected >= pp:
-            self.selected[self.current] -= pp
-          else:
-            self.selected[self.current] = 0
-          first = True
-        elif event.key in (pygame.K_RETURN, pygame.K_SPACE, pygame.K_RIGHT):
-          if self.current == 'artist':
-            self.current = 'album'
-          elif self.current == 'album':
-            self.current = 'track'
-          elif self.current == 'track':
-            artist = self.liblist['__keys__'][self.selected['artist']]
-            album = self.liblist[artist]['__keys__'][self.selected['album']]
-            track = self.liblist[artist][album]['__keys__'][self.selected['track']]
-            self.control.play_lib(self.liblist[artist][album][track])
-            return False
-          self.selected[self.current] = 0
+          pages += count
+        else:
+          pages -= count
+        first = True
+        continue
+      if rows or pages:
+        self.navigate(rows, pages, pp)
+        rows = pages = 0
+      if self.search is not None:
+        if self.search_key(event):
           first = True
-        elif event.key == pygame.K_BACKSPACE or event.key == pygame.K_LEFT:
-          if self.current == 'track':
-            self.current = 'album'
-          elif self.current == 'album':
-            self.current = 'artist'
-          elif self.current == 'artist':
-            return False
+      elif event.key == pygame.K_p:
+        if self.current == 'playlist' or self.liblist is not self.library:
+          # back to the library
+          self.current, self.selected = self.library_saved
+          self.liblist = self.library
+        else:
+          self.library_saved = (self.current, self.selected.copy())
+          self.open_playlists()
+        first = True
+      elif getattr(event, 'unicode', u'') == u'/' and self.current != 'playlist' \
+        and '__index__' in self.liblist:
+        self.search = u''
+        self.search_saved = (self.current, self.selected.copy())
+        self.hits = []
+        first = True
+      elif event.key in (pygame.K_RETURN, pygame.K_SPACE, pygame.K_RIGHT):
+        if self.current == 'playlist':
+          if not self.lists['__keys__']:
+            continue
+          self.open_playlist(self.lists['__keys__'][self.selected['playlist']])
           first = True
+          continue
+        elif self.current == 'artist':
+          self.current = 'album'
+        elif self.current == 'album':
+          self.current = 'track'
+        elif self.current == 'track':
+          artist = self.liblist['__keys__'][self.selected['artist']]
+          album = self.liblist[artist]['__keys__'][self.selected['album']]
+          track = self.liblist[artist][album]['__keys__'][self.selected['track']]
+          self.control.play_lib(self.liblist[artist][album][track])
+          # query the status in the next frame
+          self.st.updated = 0
+          return False
+        self.selected[self.current] = 0
+        first = True
+      elif event.key == pygame.K_BACKSPACE or event.key == pygame.K_LEFT:
+        if self.current == 'track':
+          self.current = 'album'
+        elif self.current == 'album':
+          self.current = 'artist'
+        elif self.current == 'artist' and self.liblist is not self.library:
+          self.current = 'playlist'
+          self.liblist = self.library
+        else:
+          return False
+        first = True
+
+    if rows or pages:
+      self.navigate(rows, pages, pp)
 
     if first:
       selected = self.selected[self.current]
-      artistlist = self.liblist['__keys__']
-      albumlist = self.liblist[artistlist[self.selected['artist']]]['__keys__'] if self.current != 'artist' else False
-      tracklist = self.liblist[artistlist[self.selected['artist']]][albumlist[self.selected['album']]]['__keys__'] if self.current == 'track' else False
-      curlist = tracklist if self.current == 'track' else albumlist if self.current == 'album' else artistlist
+      curlist = self.browser_list()
+      if self.search is not None:
+        # keep the last row for the search prompt
+        pp -= 1
       fromtop = 50
       self.browsurf.update((30, 30, width/3+40, height-60))
       self.browsurf.fill(
-        (0, 0, 0, 150),
+        self.low_memory_panel if self.low_memory else self.panel,
         (30, 30, width/3+40, height-60)
       )
       start = 0
@@ -815,23 +1563,329 @@ class Screen:
           sw, sh = self.fonts[1]['font'].size(string)
           i += 1
         if a != selected:
-          s = self.fonts[1]['font'].render(string, True, self.colors[1])
+          s = self.fonts[1]['font'].render(string, self.antialias,
+            self.colors[1])
         else:
           self.browsurf.fill(self.colors[0], (30, fromtop, width/3+40, sh))
-          s = self.fonts[1]['font'].render(string, True,
-            [255-self.colors[0][i] for i in xrange(len(self.colors[0]))]
+          s = self.fonts[1]['font'].render(string, self.antialias,
+            self.opaque([255-c for c in self.colors[0]])
           )
         sw, sh = s.get_size()
         self.browsurf.blit(s, (50, fromtop), None, False)
         fromtop += self.fonts[1]['font'].get_linesize()
+      if self.search is not None:
+        if self.hits:
+          info = u'(%d/%d)' % (self.hit + 1, len(self.hits))
+        else:
+          info = u'(no match)' if self.search else u''
+        s = self.fonts[1]['font'].render(
+          u'/%s  %s' % (self.search, info),
+          self.antialias,
+          self.colors[0]
+        )
+        self.browsurf.blit(s,
+          (50, 50 + pp * self.fonts[1]['font'].get_linesize()), None, False)
     # TODO: indicate if list is scrollable
     return True
 
+  def browser_list(self):
+    """
+    Screen.browser_list() -> list of names shown on the current browser level
+    """
+    if self.current == 'playlist':
+      return self.lists['__keys__']
+    artistlist = self.liblist['__keys__']
+    if self.current == 'artist':
+      return artistlist
+    albumlist = self.liblist[artistlist[self.selected['artist']]]['__keys__']
+    if self.current == 'album':
+      return albumlist
+    return self.liblist[artistlist[self.selected['artist']]] \
+      [albumlist[self.selected['album']]]['__keys__']
+
+  def refresh_library(self):
+    """
+    Screen.refresh_library() -> bool
+
+    Takes the library from the worker once it is done, and reloads it in
+    the background after the watcher noticed that cmus wrote its cache or
+    library. A reload which is still running then is cancelled and started
+    over. Returns True if the library was (re)placed.
+    """
+    if self.watcher.poll():
+      self.library_stale = True
+    if self.worker:
+      if self.library_stale:
+        self.worker.cancel()
+      if not self.worker.future.done():
+        return False
+      worker, self.worker = self.worker, None
+      try:
+        liblist = worker.future.result()
+      except Exception:
+        liblist = None
+      if liblist is not None:
+        if hasattr(self, 'library'):
+          self.swap_library(liblist)
+        else:
+          self.liblist = self.library = liblist
+          self.selected = {'artist': 0, 'album': -1, 'track': -1}
+          self.current = 'artist'
+          self.tagger.request(liblist.pop('__missing__', ()))
+        checkpoint('library')
+        return True
+    if self.library_stale:
+      self.library_stale = False
+      self.worker = LibraryWorker(wakeup)
+      self.apply_quality()
+    return False
+
+  def swap_library(self, liblist):
+    """
+    Screen.swap_library(liblist) -- replace the library tree
+
+    The selection is kept by name as far as the selected entries still
+    exist.
+    """
+    old, self.library = self.library, liblist
+    self.tagger.request(liblist.pop('__missing__', ()))
+    if self.liblist is not old or self.current == 'playlist':
+      # playlists are shown, go back to the top of the library later
+      if self.liblist is old:
+        self.liblist = liblist
+      self.library_saved = ('artist', {'artist': 0, 'album': -1, 'track': -1})
+      return
+    names = self.selected_names()
+    self.liblist = liblist
+    self.search = None
+    self.select_names(names)
+
+  def merge_tags(self):
+    """
+    Screen.merge_tags() -> bool
+
+    Adds the tracks which the tagger read to the library, at most tag_batch
+    per frame. This moves the entries of the search index, so it is dropped
+    and only rebuilt in the background once the tagger is done; until then,
+    the library can't be searched. Returns True if the library changed.
+    """
+    if not hasattr(self, 'library') or self.search is not None:
+      return False
+    tracks = self.tagger.poll(self.tag_batch)
+    if tracks:
+      browsing = self.liblist is self.library and self.current != 'playlist'
+      if browsing:
+        names = self.selected_names()
+      for track in tracks:
+        libtree.add_track(self.library, track)
+      if browsing:
+        self.select_names(names)
+      self.library.pop('__index__', None)
+      self.index_stale = True
+      if len(tracks) == self.tag_batch:
+        # more are waiting
+        self.scheduler.at('tags', time.time())
+      checkpoint('merge tags')
+      return True
+    if self.indexing is not None:
+      try:
+        tree, index = self.indexing.get_nowait()
+      except Queue.Empty:
+        return False
+      self.indexing = None
+      if index is not None and tree is self.library and not self.index_stale:
+        tree['__index__'] = index
+      else:
+        self.index_stale = True
+    if self.index_stale and not self.tagger.pending:
+      self.index_stale = False
+      self.indexing = Queue.Queue()
+      t = threading.Thread(target=self._index,
+        args=(self.indexing, self.library), name='index')
+      t.daemon = True
+      t.start()
+    return False
+
+  def _index(self, q, tree):
+    try:
+      index = search.Index(tree)
+    except (KeyError, IndexError, RuntimeError):
+      # the tree changed meanwhile
+      index = None
+    q.put((tree, index))
+    wakeup()
+
+  def selected_names(self):
+    """
+    Screen.selected_names() -> names of the selected artist, album and track
+
+    Only the levels up to the current one are included.
+    """
+    levels = ('artist', 'album', 'track')
+    names = []
+    level = self.liblist
+    for key in levels[:levels.index(self.current) + 1]:
+      i = self.selected[key]
+      if not 0 <= i < len(level['__keys__']):
+        break
+      names.append(level['__keys__'][i])
+      level = level[names[-1]]
+    return names
+
+  def select_names(self, names):
+    """
+    Screen.select_names(names) -- select the browser entries with the names
+    returned by selected_names(), as far as they still exist
+    """
+    levels = ('artist', 'album', 'track')
+    selected = {'artist': 0, 'album': -1, 'track': -1}
+    depth = 0
+    level = self.liblist
+    for key, name in zip(levels, names):
+      if name not in level:
+        break
+      selected[key] = level['__keys__'].index(name)
+      level = level[name]
+      depth += 1
+    self.current = levels[max(depth - 1, 0)]
+    self.selected.update(selected)
+
+  def acceleration(self, key):
+    """
+    Screen.acceleration(key) -> number of rows one press of key moves
+
+    While UP or DOWN is held, the presses arrive at most hold_gap seconds
+    apart. After hold_delay seconds of holding, the rows per press double
+    every hold_rate seconds, up to hold_max rows.
+    """
+    now = time.time()
+    if self.held is None or self.held[0] != key \
+      or now - self.held[2] > self.hold_gap:
+        self.held = (key, now, now)
+    else:
+      self.held = (key, self.held[1], now)
+    held = now - self.held[1] - self.hold_delay
+    if held <= 0:
+      return 1
+    return min(self.hold_max, 2 ** int(held / self.hold_rate + 1))
+
+  def navigate(self, rows, pages, pp):
+    """
+    Screen.navigate(rows, pages, pp) -- move the browser selection
+
+    Moves by rows plus pages times pp entries. Moving past an end of the
+    list stops there; moving on by rows from the end wraps around.
+    """
+    curlist = self.browser_list()
+    if not curlist:
+      return
+    last = len(curlist) - 1
+    selected = self.selected[self.current]
+    target = selected + rows + pages * pp
+    if target > last:
+      target = 0 if selected == last and not pages else last
+    elif target < 0:
+      target = last if selected == 0 and not pages else 0
+    self.selected[self.current] = target
+
+  def search_key(self, event):
+    """
+    Screen.search_key(event) -> bool
+
+    Handles a key press while the browser's search prompt is open. Every
+    change of the query selects the first hit, UP and DOWN cycle through the
+    hits, RETURN keeps the selection and ESCAPE restores the previous one.
+    Returns True if the browser needs to be redrawn.
+    """
+    char = getattr(event, 'unicode', u'')
+    if event.key == pygame.K_ESCAPE \
+      or event.key == pygame.K_BACKSPACE and self.search == u'':
+        self.current, self.selected = self.search_saved
+        self.search = None
+    elif event.key == pygame.K_RETURN:
+      self.search = None
+    elif event.key in (pygame.K_DOWN, pygame.K_UP):
+      if not self.hits:
+        return False
+      # repeated presses are coalesced into one event
+      step = getattr(event, 'count', 1)
+      if event.key == pygame.K_UP:
+        step = -step
+      self.hit = (self.hit + step) % len(self.hits)
+      self.jump_to(self.hits[self.hit])
+    elif event.key == pygame.K_BACKSPACE or char and char >= u' ':
+      if event.key == pygame.K_BACKSPACE:
+        self.search = self.search[:-1]
+      else:
+        self.search += char
+      self.hits = self.liblist['__index__'].find(self.search)
+      self.hit = 0
+      if self.hits:
+        self.jump_to(self.hits[0])
+      checkpoint('search')
+    else:
+      return False
+    return True
+
+  def jump_to(self, entry):
+    """
+    Screen.jump_to(entry) -- select a search index entry in the browser
+    """
+    level, (artist, album, track) = self.liblist['__index__'].path(entry)
+    self.current = ('artist', 'album', 'track')[level]
+    self.selected.update(artist=artist, album=album, track=track)
+
+  def open_playlists(self):
+    """
+    Screen.open_playlists() -- show the list of cmus playlists in the browser
+    """
+    self.lists = libtree.new_level()
+    for name, path in cmus.playlists().iteritems():
+      libtree.insert(self.lists, name, path, libtree.collate(name))
+    self.current = 'playlist'
+    self.selected['playlist'] = 0
+
+  def open_playlist(self, name):
+    """
+    Screen.open_playlist(name) -- browse the tracks of a playlist
+
+    A PlaylistWorker streams the playlist file and looks up its tracks in
+    the cmus cache, which gives a library tree of their own to browse and
+    search. take_playlist() picks it up.
+    """
+    self.playlist_worker = PlaylistWorker(self.lists[name], wakeup)
+    self.apply_quality()
+
+  def take_playlist(self):
+    """
+    Screen.take_playlist() -> bool
+
+    Browses the playlist tree once the worker is done. Returns False while
+    it is still running; if reading failed, the list of playlists stays.
+    """
+    if not self.playlist_worker.future.done():
+      return False
+    worker, self.playlist_worker = self.playlist_worker, None
+    try:
+      tree = worker.future.result()
+    except Exception:
+      tree = None
+    if tree is not None:
+      self.liblist = tree
+      self.current = 'artist'
+      self.selected['artist'] = 0
+    checkpoint('playlist')
+    return True
+
 def start():
+  try:
+    # sort the library by the user's collation rules
+    locale.setlocale(locale.LC_COLLATE, '')
+  except locale.Error:
+    pass
   m = Screen()
   checkpoint('startup', True)
   while 1:
-    step = 0.05
     loop_start = time.time()
     checkpoint('first')
     if not m.loop():
@@ -840,7 +1894,23 @@ def start():
     if DEBUG:
       print 'checkpoint            loop: %f' % timediff
       print '------------------------'
-    time.sleep(step-(timediff%step))
+    m.scheduler.wait()
+
+def broker(interval = 0.5):
+  """
+  broker([interval]) -- publish the cmus status for other screens
+
+  Queries cmus every interval seconds and publishes the status through
+  shared memory, where the Screens on this host pick it up instead of
+  querying cmus themselves.
+  """
+  st = cmus.Broker()
+  try:
+    while 1:
+      time.sleep(interval)
+      st.update()
+  except KeyboardInterrupt:
+    pass
 
 if __name__ == '__main__':
   # Import Psyco if available
@@ -849,6 +1919,9 @@ if __name__ == '__main__':
     psyco.full()
   except ImportError:
     pass
-  start()
+  if '--broker' in sys.argv[1:]:
+    broker()
+  else:
+    start()
 
 # vim: set sw=2 et
@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+"""
+hardware accelerated compositing
+
+With pygame 2, the display layers can be kept as SDL2 textures: the static
+background is uploaded once, the overlay layers only in the rectangles which
+changed, and every frame just draws a few textured quads. The SDL render
+driver can be chosen with SDL_RENDER_DRIVER, e.g. "opengl", which also works
+without GPU through Mesa's llvmpipe. Without pygame._sdl2, create() returns
+None and the software path is used.
+"""
+
+import pygame
+
+try:
+  from pygame._sdl2.video import Window, Renderer, Texture
+except ImportError:
+  Renderer = None
+
+# SDL_BLENDMODE_BLEND
+BLEND = 1
+
+# SDL_WINDOWPOS_CENTERED_DISPLAY(0)
+CENTERED = 0x2FFF0000
+
+def create(title, size, fullscreen = False, vsync = False, display = 0):
+  """
+  create(title, size, [fullscreen, [vsync, [display]]]) -> Compositor or None
+
+  Opens a window with an SDL renderer on the given SDL display. The pygame
+  display only gets a hidden 1x1 mode, which Surface.convert() needs.
+  """
+  if Renderer is None:
+    return None
+  try:
+    pygame.display.set_mode((1, 1), pygame.HIDDEN)
+    window = Window(title, size, (CENTERED | display, CENTERED | display),
+      fullscreen=fullscreen)
+    return Compositor(window, Renderer(window, vsync=vsync))
+  except (pygame.error, ValueError):
+    return None
+
+class Compositor:
+  """
+  Compositor(window, renderer) -- draws layer textures onto the window
+
+  Layers are kept by name and drawn in the order of their first upload.
+  """
+  def __init__(self, window, renderer):
+    self.window = window
+    self.renderer = renderer
+    self.renderer.draw_color = (0, 0, 0, 255)
+    self.textures = {}
+    self.order = []
+
+  def get_size(self):
+    return self.window.size
+
+  def close(self):
+    # textures before their renderer, the renderer before its window
+    self.textures = {}
+    self.renderer = None
+    self.window.destroy()
+
+  def upload(self, name, surface, rects = None):
+    """
+    Compositor.upload(name, surface, [rects]) -- update a layer texture
+
+    Uploads the given rects of surface, or all of it. The texture is
+    (re)created if the surface size changed.
+    """
+    texture = self.textures.get(name)
+    if texture is None or texture.get_rect().size != surface.get_size():
+      texture = Texture.from_surface(self.renderer, surface)
+      texture.blend_mode = BLEND
+      self.textures[name] = texture
+      if name not in self.order:
+        self.order.append(name)
+      return
+    if rects is None:
+      texture.update(surface)
+      return
+    bounds = surface.get_rect()
+    for rect in rects:
+      rect = bounds.clip(rect)
+      if rect.width and rect.height:
+        texture.update(surface.subsurface(rect), rect)
+
+  def present(self, names, offset):
+    """
+    Compositor.present(names, offset) -- draw the named layers at offset
+    """
+    self.renderer.clear()
+    for name in self.order:
+      if name in names:
+        texture = self.textures[name]
+        texture.draw(None, pygame.Rect(offset, texture.get_rect().size))
+    self.renderer.present()
+
+# vim: set sw=2 et
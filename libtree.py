@@ -0,0 +1,111 @@
+# -*- coding: utf-8 -*-
+"""
+library tree helpers
+
+The library tree is a dict of artists, each a dict of albums, each a dict of
+tracks. Every level keeps its entries in browser order in '__keys__' and the
+matching sort keys in '__sortkeys__'. Sort keys are computed once when an
+entry is inserted, and new entries are placed with bisect, so a level never
+has to be re-sorted.
+"""
+
+import os, re, bisect, locale
+
+_digits = re.compile(r'(\d+)', re.UNICODE)
+_article = re.compile(r'^the\s+', re.UNICODE | re.IGNORECASE)
+
+def collate(name):
+  """
+  collate(name) -> tuple
+
+  Returns a natural, locale-aware sort key for name: runs of digits compare by
+  their numeric value, the text between them by locale.strxfrm() of its lower
+  case form. Text and numbers always alternate, starting with text, so keys
+  never compare values of different types.
+  """
+  if isinstance(name, str):
+    name = name.decode('utf-8', 'replace')
+  parts = _digits.split(name.lower())
+  for i in xrange(0, len(parts), 2):
+    parts[i] = locale.strxfrm(parts[i].encode('utf-8'))
+  for i in xrange(1, len(parts), 2):
+    parts[i] = int(parts[i])
+  return tuple(parts)
+
+def strip_article(name):
+  """
+  strip_article(name) -> name without a leading "The"
+  """
+  if isinstance(name, str):
+    name = name.decode('utf-8', 'replace')
+  return _article.sub(u'', name, 1) or name
+
+def artist_key(name):
+  """
+  artist_key(name) -> sort key for an artist, ignoring a leading "The"
+  """
+  return collate(strip_article(name))
+
+album_key = collate
+
+def _number(value):
+  try:
+    return int(str(value).split('/', 1)[0])
+  except ValueError:
+    return 0
+
+def track_key(title, track):
+  """
+  track_key(title, track) -> sort key for a track
+
+  Orders by disc and track number; tracks without a disc number count as
+  disc 1, tracks without a track number follow the numbered ones of their
+  disc, sorted by title.
+  """
+  number = _number(track.get('tracknumber', 0))
+  return (_number(track.get('discnumber', 1)) or 1, 0 if number else 1, number,
+    collate(title))
+
+def names(track):
+  """
+  names(track) -> (artist, album, title)
+
+  Returns the names under which track is listed in the tree, using dummy
+  values for missing tags.
+  """
+  artist = track.get('albumartist') or track.get('artist') or '[unknown]'
+  album = track.get('album') or '[unknown]'
+  title = track.get('title') or os.path.basename(track['file']).rsplit('.', 1)[0]
+  return artist, album, title
+
+def new_level():
+  return {'__keys__': [], '__sortkeys__': []}
+
+def insert(level, name, value, key):
+  """
+  insert(level, name, value, key) -- add or replace an entry of a level
+  """
+  keys, sortkeys = level['__keys__'], level['__sortkeys__']
+  if name in level:
+    i = keys.index(name)
+    del keys[i], sortkeys[i]
+  i = bisect.bisect_right(sortkeys, key)
+  keys.insert(i, name)
+  sortkeys.insert(i, key)
+  level[name] = value
+
+def add_track(liblist, track):
+  """
+  add_track(liblist, track) -- add a track dict to the library tree
+
+  Creates artist and album levels as needed.
+  """
+  artist, album, title = names(track)
+  if artist not in liblist:
+    insert(liblist, artist, new_level(), artist_key(artist))
+  albums = liblist[artist]
+  if album not in albums:
+    insert(albums, album, new_level(), album_key(album))
+  insert(albums[album], title, track, track_key(title, track))
+
+# vim: set sw=2 et
@@ -0,0 +1,124 @@
+# -*- coding: utf-8 -*-
+"""
+input handling
+
+Input merges the key presses from the pygame event queue and the codes of a
+LIRC remote control into one list of KEYDOWN events per frame. LIRC is read
+by a background thread, which hands the codes over through a bounded deque;
+appending and popping are atomic, so neither side takes a lock, and remote
+presses aren't lost during slow frames. Repeated navigation keys are merged
+into one event with a count attribute.
+"""
+
+import time, threading, collections
+import pygame
+
+try:
+  import pylirc
+except ImportError:
+  pylirc = None
+
+# LIRC codes (see ~/.lircrc, program cmus-fullscreen) and the keys they press
+CODES = {
+  'up': pygame.K_UP,
+  'down': pygame.K_DOWN,
+  'page-up': pygame.K_PAGEUP,
+  'page-down': pygame.K_PAGEDOWN,
+  'select': pygame.K_SPACE,
+  'back': pygame.K_BACKSPACE,
+  'browser': pygame.K_UNKNOWN,
+}
+
+# keys whose repeats are merged
+NAVIGATION = (pygame.K_UP, pygame.K_DOWN, pygame.K_PAGEUP, pygame.K_PAGEDOWN)
+
+def coalesce(events):
+  """
+  coalesce(events) -> list of events
+
+  Merges runs of the same navigation key into a single event, whose count
+  attribute tells how often the key was pressed.
+  """
+  result = []
+  for event in events:
+    if result and event.type == pygame.KEYDOWN and event.key in NAVIGATION \
+      and result[-1].type == pygame.KEYDOWN and result[-1].key == event.key:
+        merged = dict(result[-1].dict)
+        merged['count'] = merged.get('count', 1) + 1
+        result[-1] = pygame.event.Event(pygame.KEYDOWN, merged)
+    else:
+      result.append(event)
+  return result
+
+class Input:
+  """
+  Input([notify, [size]]) -- keyboard and remote control input
+
+  notify is called from the LIRC thread after a code arrived. At most size
+  codes are buffered; if the render loop falls that far behind, the oldest
+  ones are dropped. Only the navigation keys repeat while held down, which
+  needs KEYUP events to be allowed.
+  """
+  # seconds to wait after lircd stopped answering
+  retry = 1.0
+
+  def __init__(self, notify = None, size = 64):
+    self.notify = notify
+    self._held = set()
+    self._codes = collections.deque(maxlen=size)
+    self.lirc = False
+    if pylirc:
+      try:
+        self.lirc = bool(pylirc.init('cmus-fullscreen', None, 1))
+      except RuntimeError:
+        self.lirc = False
+    if self.lirc:
+      self._thread = threading.Thread(target=self._read, name='lirc')
+      self._thread.daemon = True
+      self._thread.start()
+
+  def _read(self):
+    while self.lirc:
+      codes = pylirc.nextcode()
+      if not codes:
+        # in blocking mode, nextcode() only returns nothing if lircd went
+        # away; don't spin until it is back
+        time.sleep(self.retry)
+        continue
+      self._codes.extend(codes)
+      if self.notify:
+        self.notify()
+
+  def events(self):
+    """
+    Input.events() -> list of QUIT and KEYDOWN events since the last call
+
+    Events for LIRC codes carry the code in their lirc attribute.
+    """
+    events = []
+    for e in pygame.event.get():
+      if e.type == pygame.KEYUP:
+        self._held.discard(e.key)
+      elif e.type == pygame.KEYDOWN:
+        # pygame repeats all keys; a KEYUP may be lost when the window is
+        # recreated, so held keys are checked to be still down
+        if e.key in self._held and e.key not in NAVIGATION \
+          and pygame.key.get_pressed()[e.key]:
+            continue
+        self._held.add(e.key)
+        events.append(e)
+      elif e.type == pygame.QUIT:
+        events.append(e)
+    while self._codes:
+      code = self._codes.popleft()
+      if code in CODES:
+        events.append(pygame.event.Event(pygame.KEYDOWN,
+          {'key': CODES[code], 'unicode': u'', 'mod': 0, 'lirc': code}))
+    return coalesce(events)
+
+  def close(self):
+    if self.lirc:
+      self.lirc = False
+      pylirc.exit()
+
+# vim: set sw=2 et
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+search index for the library browser
+
+An Index is built once from the library tree created by LibraryWorker and
+answers incremental search queries over artist, album and track names.
+Queries shorter than three characters match name prefixes through a sorted
+array, which also lists artists without a leading "The" like the browser
+sorts them; longer ones match substrings through indexes of the three and four
+character substrings (n-grams) of all names. Queries of three or four
+characters are looked up directly; for longer ones, only the names in the
+shortest posting list of their 4-grams are checked. A query which extends
+the previous one only filters the previous hits.
+"""
+
+import bisect, array
+import libtree
+
+ARTIST, ALBUM, TRACK = 0, 1, 2
+
+def ngrams(name, n):
+  return set([name[i:i+n] for i in xrange(len(name) - n + 1)])
+
+class Index:
+  """
+  Index(liblist) -- search index over a library tree
+
+  Every artist, album and track is an entry. Entries are numbered artists
+  first, then albums, then tracks, each in browser order, so hits come out
+  ordered by level and position.
+  """
+  def __init__(self, liblist):
+    self.names = []
+    self.paths = []
+    self.levels = []
+    artists = liblist['__keys__']
+    for a, artist in enumerate(artists):
+      self._add(ARTIST, artist, (a, -1, -1))
+    for a, artist in enumerate(artists):
+      for b, album in enumerate(liblist[artist]['__keys__']):
+        self._add(ALBUM, album, (a, b, -1))
+    for a, artist in enumerate(artists):
+      for b, album in enumerate(liblist[artist]['__keys__']):
+        for t, track in enumerate(liblist[artist][album]['__keys__']):
+          self._add(TRACK, track, (a, b, t))
+
+    # sorted prefix array: entry ids ordered by name, artists also by their
+    # name without "The"
+    keys = [(name, i) for i, name in enumerate(self.names)]
+    for i in xrange(len(artists)):
+      bare = libtree.strip_article(self.names[i])
+      if bare != self.names[i]:
+        keys.append((bare, i))
+    keys.sort()
+    self.prefix = [i for name, i in keys]
+    self.prefix_names = [name for name, i in keys]
+
+    # posting lists of entry ids by n-gram, for n = 3 and 4
+    self.grams = {3: {}, 4: {}}
+    for n, postings in self.grams.iteritems():
+      for i, name in enumerate(self.names):
+        for gram in ngrams(name, n):
+          if gram not in postings:
+            postings[gram] = array.array('i')
+          postings[gram].append(i)
+
+    self._last = (u'', [])
+
+  def _add(self, level, name, path):
+    if isinstance(name, str):
+      name = name.decode('utf-8', 'replace')
+    self.names.append(name.lower())
+    self.paths.append(path)
+    self.levels.append(level)
+
+  def __len__(self):
+    return len(self.names)
+
+  def find(self, query):
+    """
+    Index.find(query) -> list of entry ids
+
+    Returns the ids of all entries matching query (case-insensitive). Hits
+    for queries shorter than three characters are name prefix matches in
+    alphabetical order, other hits are substring matches in entry order.
+    """
+    query = query.lower()
+    if query == u'':
+      hits = []
+    elif len(query) < 3:
+      lo = bisect.bisect_left(self.prefix_names, query)
+      hi = bisect.bisect_left(self.prefix_names, query + u'\uffff', lo)
+      hits = self.prefix[lo:hi]
+      if u'the '.startswith(query):
+        # artists may match with and without "The"
+        seen = set()
+        hits = [i for i in hits if not (i in seen or seen.add(i))]
+    elif len(query) <= 4:
+      # the posting list is exact, no need to verify it
+      hits = self.grams[len(query)].get(query, ())
+    else:
+      last, lasthits = self._last
+      postings = self.grams[4]
+      candidates = min([postings.get(gram, ()) for gram in ngrams(query, 4)],
+        key=len)
+      if len(last) >= 3 and query.startswith(last) \
+        and len(lasthits) < len(candidates):
+          candidates = lasthits
+      names = self.names
+      hits = [i for i in candidates if query in names[i]]
+    self._last = (query, hits)
+    return hits
+
+  def path(self, entry):
+    """
+    Index.path(entry) -> (level, (artist, album, track))
+
+    Returns the browser level of the entry and the indices into the
+    '__keys__' lists needed to select it (-1 for unused levels).
+    """
+    return self.levels[entry], self.paths[entry]
+
+# vim: set sw=2 et
@@ -1,8 +1,13 @@
 import pygame
 
-def gen_gradient(size, color1, color2):
+def gen_gradient(size, color1, color2, palette = None):
   width, height = size
-  surface = pygame.Surface(size)
+  if palette:
+    # lines are drawn in the closest palette colors
+    surface = pygame.Surface(size, 0, 8)
+    surface.set_palette(palette)
+  else:
+    surface = pygame.Surface(size)
   step = [float(color2[i] - color1[i]) / height for i in xrange(len(color1))]
   for i in xrange(height):
     pygame.draw.line(surface,
@@ -12,6 +17,26 @@ def gen_gradient(size, color1, color2):
     )
   return surface
 
+def gen_palette(color1, color2, steps = 40):
+  """
+  gen_palette(color1, color2, [steps]) -> list of 256 colors
+
+  Returns a palette holding a ramp of steps colors from color1 to color2 for
+  the gradient, filled up with a color cube for everything else.
+  """
+  palette = [
+    [color1[j] + (color2[j] - color1[j]) * i / (steps - 1) for j in xrange(3)]
+    for i in xrange(steps)
+  ]
+  levels = 1
+  while (levels + 1) ** 3 <= 256 - steps:
+    levels += 1
+  for r in xrange(levels):
+    for g in xrange(levels):
+      for b in xrange(levels):
+        palette.append([c * 255 / (levels - 1) for c in (r, g, b)])
+  return palette + [[0, 0, 0]] * (256 - len(palette))
+
 def gen_dot(radius, color):
   width, height = size = [radius*2]*2
   surface = pygame.Surface(size)
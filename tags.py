@@ -0,0 +1,295 @@
+# -*- coding: utf-8 -*-
+"""
+tag reading for files missing from the cmus cache
+
+cmus only caches the tags of files it has seen; files in lib.pl which are
+not in the cache would be missing from the browser. read() gets their tags
+from the file headers only: ID3v2 frames (with ID3v1 as fallback), FLAC
+Vorbis comments and the comment header of Ogg Vorbis and Opus files. A
+Tagger reads them in a few background threads and remembers the results in
+a cache of its own, keyed by path and modification time.
+"""
+
+import os, struct, marshal, threading, Queue
+
+# ID3v2 frames and Vorbis comments, and the cmus cache keys they map to
+FRAMES = {
+  'TIT2': 'title',
+  'TPE1': 'artist',
+  'TPE2': 'albumartist',
+  'TALB': 'album',
+  'TRCK': 'tracknumber',
+  'TPOS': 'discnumber',
+  'TDRC': 'date',
+  'TYER': 'date',
+  'TCON': 'genre',
+}
+COMMENTS = {
+  'TITLE': 'title',
+  'ARTIST': 'artist',
+  'ALBUMARTIST': 'albumartist',
+  'ALBUM': 'album',
+  'TRACKNUMBER': 'tracknumber',
+  'DISCNUMBER': 'discnumber',
+  'DATE': 'date',
+  'GENRE': 'genre',
+}
+# bytes searched for the comment header of Ogg files
+OGG_HEADER = 1 << 16
+
+def _text(frame):
+  encoding = ord(frame[0]) if frame else 0
+  data = frame[1:]
+  try:
+    if encoding == 0:
+      text = data.decode('latin-1')
+    elif encoding == 1:
+      text = data.decode('utf-16')
+    elif encoding == 2:
+      text = data.decode('utf-16-be')
+    else:
+      text = data.decode('utf-8')
+  except UnicodeError:
+    return ''
+  # several values are separated by NUL, keep the first
+  return text.split(u'\0', 1)[0].strip().encode('utf-8')
+
+def _syncsafe(data):
+  b = [ord(c) for c in data]
+  return b[0] << 21 | b[1] << 14 | b[2] << 7 | b[3]
+
+def read_id3(fd, tags):
+  header = fd.read(10)
+  if len(header) < 10 or header[0:3] != 'ID3' or ord(header[3]) not in (3, 4):
+    return False
+  version = ord(header[3])
+  data = fd.read(_syncsafe(header[6:10]))
+  pos = 0
+  if ord(header[5]) & 0x40:
+    # extended header
+    size = data[0:4]
+    pos = _syncsafe(size) if version == 4 else struct.unpack('>L', size)[0] + 4
+  while pos + 10 <= len(data) and data[pos] != '\0':
+    name = data[pos:pos+4]
+    if version == 4:
+      size = _syncsafe(data[pos+4:pos+8])
+    else:
+      size = struct.unpack('>L', data[pos+4:pos+8])[0]
+    if name in FRAMES and FRAMES[name] not in tags:
+      text = _text(data[pos+10:pos+10+size])
+      if text:
+        tags[FRAMES[name]] = text
+    pos += 10 + size
+  return True
+
+def read_id3v1(fd, tags):
+  try:
+    fd.seek(-128, 2)
+  except IOError:
+    return False
+  data = fd.read(128)
+  if data[0:3] != 'TAG':
+    return False
+  for key, start, end in (('title', 3, 33), ('artist', 33, 63),
+                          ('album', 63, 93), ('date', 93, 97)):
+    text = data[start:end].split('\0', 1)[0].strip()
+    if text and key not in tags:
+      tags[key] = text.decode('latin-1').encode('utf-8')
+  if data[125] == '\0' and data[126] != '\0' and 'tracknumber' not in tags:
+    tags['tracknumber'] = str(ord(data[126]))
+  return True
+
+def _comments(data, tags):
+  pos = 4 + struct.unpack('<L', data[0:4])[0]
+  count = struct.unpack('<L', data[pos:pos+4])[0]
+  pos += 4
+  for i in xrange(count):
+    if pos + 4 > len(data):
+      break
+    length = struct.unpack('<L', data[pos:pos+4])[0]
+    comment = data[pos+4:pos+4+length]
+    pos += 4 + length
+    key, sep, value = comment.partition('=')
+    key = COMMENTS.get(key.upper())
+    if sep and key and value and key not in tags:
+      tags[key] = value
+
+def read_flac(fd, tags):
+  if fd.read(4) != 'fLaC':
+    return False
+  last = False
+  while not last:
+    header = fd.read(4)
+    if len(header) < 4:
+      break
+    last = ord(header[0]) & 0x80
+    length = struct.unpack('>L', '\0' + header[1:4])[0]
+    if ord(header[0]) & 0x7f == 4:
+      _comments(fd.read(length), tags)
+      break
+    fd.seek(length, 1)
+  return True
+
+def read_ogg(fd, tags):
+  data = fd.read(OGG_HEADER)
+  if data[0:4] != 'OggS':
+    return False
+  for magic in ('\x03vorbis', 'OpusTags'):
+    pos = data.find(magic)
+    if pos >= 0:
+      _comments(data[pos+len(magic):], tags)
+      break
+  return True
+
+def read(file):
+  """
+  read(file) -> dict of tags like a cmus cache entry, or None
+
+  Only reads the headers of file. Returns None if it can't be read; files
+  without known tags are listed under their name, so just their path is
+  returned.
+  """
+  tags = {'file': file}
+  try:
+    fd = open(file, 'rb')
+  except IOError:
+    return None
+  try:
+    for reader in (read_id3, read_flac, read_ogg):
+      fd.seek(0)
+      try:
+        if reader(fd, tags):
+          break
+      except (struct.error, IndexError, ValueError):
+        break
+    if 'title' not in tags or 'artist' not in tags:
+      read_id3v1(fd, tags)
+  except IOError:
+    return None
+  finally:
+    fd.close()
+  if 'tracknumber' in tags:
+    try:
+      tags['tracknumber'] = int(tags['tracknumber'].split('/', 1)[0])
+    except ValueError:
+      tags['tracknumber'] = 0
+  return tags
+
+class Tagger:
+  """
+  Tagger([threads, [cachefile, [notify]]]) -- background tag reader
+
+  Reads the tags of the files passed to request() in a fixed number of
+  threads. poll() returns the tracks read so far and must be called from
+  the same thread as request(). Tags of unchanged files are taken from
+  cachefile, which is written once all requests are done. notify is called
+  from the reading threads whenever results are ready.
+  """
+  version = 2
+
+  def __init__(self, threads = 2, cachefile = None, notify = None):
+    self.notify = notify
+    self.cachefile = cachefile or os.path.join(
+      os.environ.get('XDG_CACHE_HOME', os.path.expanduser(os.path.join('~', '.cache'))),
+      'cmus-fullscreen', 'tags')
+    self.pending = 0
+    self._cache = self._load()
+    self._seen = set()
+    self._dirty = False
+    self._requests = Queue.Queue()
+    self._results = Queue.Queue()
+    self._threads = []
+    for i in xrange(threads):
+      thread = threading.Thread(target=self._work, name='tags')
+      thread.daemon = True
+      thread.start()
+      self._threads.append(thread)
+
+  def _load(self):
+    try:
+      fd = open(self.cachefile, 'rb')
+      try:
+        version, cache = marshal.load(fd)
+      finally:
+        fd.close()
+    except (IOError, EOFError, ValueError, TypeError):
+      return {}
+    if version != self.version:
+      return {}
+    return cache
+
+  def save(self):
+    """
+    Tagger.save() -- write the cache, keeping only the files requested
+    """
+    cache = dict((path, self._cache[path]) for path in self._seen
+      if path in self._cache)
+    try:
+      directory = os.path.dirname(self.cachefile)
+      if not os.path.isdir(directory):
+        os.makedirs(directory)
+      tmp = self.cachefile + '.tmp'
+      fd = open(tmp, 'wb')
+      marshal.dump((self.version, cache), fd)
+      fd.close()
+      os.rename(tmp, self.cachefile)
+    except (IOError, OSError):
+      pass
+    self._dirty = False
+
+  def request(self, files):
+    """
+    Tagger.request(files) -- read the tags of files in the background
+    """
+    for file in files:
+      self._seen.add(file)
+      self.pending += 1
+      self._requests.put(file)
+
+  def poll(self, limit = None):
+    """
+    Tagger.poll([limit]) -> list of at most limit track dicts read since
+    the last call
+    """
+    tracks = []
+    while limit is None or len(tracks) < limit:
+      try:
+        file, mtime, track = self._results.get_nowait()
+      except Queue.Empty:
+        break
+      self.pending -= 1
+      if mtime is not None and self._cache.get(file, (None,))[0] != mtime:
+        self._cache[file] = (mtime, track)
+        self._dirty = True
+      if track:
+        tracks.append(track)
+    if self.pending == 0 and self._dirty:
+      self.save()
+    return tracks
+
+  def stop(self):
+    for thread in self._threads:
+      self._requests.put(None)
+
+  def _work(self):
+    os.nice(1)
+    while True:
+      file = self._requests.get()
+      if file is None:
+        return
+      try:
+        mtime = os.stat(file).st_mtime
+      except OSError:
+        mtime = None
+      cached = self._cache.get(file)
+      if cached and cached[0] == mtime:
+        track = cached[1]
+      else:
+        track = read(file) if mtime is not None else None
+      # wake up the reader only for the first result it hasn't picked up
+      first = self._results.empty()
+      self._results.put((file, mtime, track))
+      if self.notify and first:
+        self.notify()
+
+# vim: set sw=2 et
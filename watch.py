@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+"""
+file change notification
+
+A Watcher reports changes of a few files through Linux' inotify, called
+through ctypes. Its thread sleeps in select() until something happens in
+one of the watched directories, so watching costs nothing while the files
+stay the same. A burst of changes, like cmus writing its cache, is reported
+once, after it is over.
+"""
+
+import os, errno, struct, select, threading, ctypes, ctypes.util
+
+IN_CLOSE_WRITE = 0x008
+IN_MOVED_TO = 0x080
+IN_CREATE = 0x100
+IN_DELETE = 0x200
+
+try:
+  _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+  _libc.inotify_init
+except (OSError, AttributeError):
+  _libc = None
+
+_event = struct.Struct('iIII')
+
+class Watcher:
+  """
+  Watcher(paths, [delay, [notify]]) -- watch files for changes
+
+  poll() returns True once after any of the files was written, replaced or
+  deleted and delay seconds passed without further changes. notify is
+  called from the watcher thread at that time. The directories of the files
+  are watched, so files which are replaced by renaming are still noticed.
+  If inotify isn't available, available is False and nothing is reported.
+  """
+  def __init__(self, paths, delay = 2.0, notify = None):
+    self.delay = delay
+    self.notify = notify
+    self.available = False
+    self._changed = threading.Event()
+    self._names = {}
+    if _libc is None:
+      return
+    self._fd = _libc.inotify_init()
+    if self._fd < 0:
+      return
+    mask = IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE | IN_DELETE
+    for path in paths:
+      directory, name = os.path.split(os.path.abspath(path))
+      wd = _libc.inotify_add_watch(self._fd, directory, mask)
+      if wd >= 0:
+        self._names.setdefault(wd, set()).add(name)
+    if not self._names:
+      os.close(self._fd)
+      return
+    self._stop = os.pipe()
+    self.available = True
+    self._thread = threading.Thread(target=self._work, name='watch')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def _read(self):
+    """returns whether the pending events concern a watched file"""
+    data = os.read(self._fd, 4096)
+    found = False
+    pos = 0
+    while pos + _event.size <= len(data):
+      wd, mask, cookie, length = _event.unpack_from(data, pos)
+      pos += _event.size
+      name = data[pos:pos+length].rstrip('\0')
+      pos += length
+      if name in self._names.get(wd, ()):
+        found = True
+    return found
+
+  def _wait(self, timeout = None):
+    """returns whether events are pending before timeout or close()"""
+    while True:
+      try:
+        ready = select.select([self._fd, self._stop[0]], [], [], timeout)[0]
+      except select.error, e:
+        if e.args[0] == errno.EINTR:
+          continue
+        raise
+      if self._stop[0] in ready:
+        raise EOFError
+      return bool(ready)
+
+  def _work(self):
+    try:
+      while True:
+        self._wait()
+        if not self._read():
+          continue
+        while self._wait(self.delay):
+          self._read()
+        self._changed.set()
+        if self.notify:
+          self.notify()
+    except (EOFError, OSError):
+      pass
+    finally:
+      os.close(self._fd)
+      os.close(self._stop[0])
+
+  def poll(self):
+    """
+    Watcher.poll() -> True if a file changed since the last call
+    """
+    if self._changed.is_set():
+      self._changed.clear()
+      return True
+    return False
+
+  def close(self):
+    if self.available:
+      self.available = False
+      os.write(self._stop[1], 'x')
+      os.close(self._stop[1])
+      self._thread.join()
+
+# vim: set sw=2 et
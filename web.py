@@ -0,0 +1,243 @@
+# -*- coding: utf-8 -*-
+"""
+HTTP status endpoint
+
+A Server answers GET / with the last status published by the Screen as JSON,
+so any number of dashboards can show what's playing without querying cmus.
+It runs in a thread of its own, which waits in select() on non-blocking
+sockets; the status is only encoded when it is published.
+
+Every response carries an ETag. A request whose If-None-Match matches the
+current one gets 304 Not Modified, or, with a wait=<seconds> query, is held
+until the status changes or the time is up (long polling). The position
+changes every second and doesn't change the ETag; clients extrapolate it
+from the updated time while playing.
+"""
+
+import os, time, errno, socket, select, threading, json, urlparse
+
+# bytes of a request, and seconds to receive it
+MAX_REQUEST = 8192
+REQUEST_TIMEOUT = 10.0
+
+REASONS = {
+  200: 'OK',
+  304: 'Not Modified',
+  400: 'Bad Request',
+  404: 'Not Found',
+  405: 'Method Not Allowed',
+}
+
+class Client:
+  def __init__(self, sock, deadline):
+    self.sock = sock
+    self.request = ''
+    self.response = ''
+    self.deadline = deadline
+    # ETag the client waits to change, and whether to send only headers
+    self.etag = None
+    self.head = False
+
+class Server:
+  """
+  Server(port, [address, [timeout]]) -- serve the status over HTTP
+
+  publish() sets the status document. timeout limits the seconds a long
+  poll is held. Raises socket.error if the port can't be bound.
+  """
+  def __init__(self, port, address = '', timeout = 60.0):
+    self.timeout = timeout
+    # restarts mustn't repeat the ETags of an earlier run
+    self._prefix = '%x' % int(time.time())
+    self._version = 0
+    self._document = ('"%s-0"' % self._prefix, '{}')
+    self._clients = {}
+    self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self._sock.bind((address, port))
+    self._sock.listen(16)
+    self._sock.setblocking(0)
+    self._wake = os.pipe()
+    self._stopped = False
+    self._thread = threading.Thread(target=self._work, name='web')
+    self._thread.daemon = True
+    self._thread.start()
+
+  def publish(self, status):
+    """
+    Server.publish(status) -- make status the new document
+
+    status is encoded right away, so it may change afterwards. Waiting
+    clients are answered.
+    """
+    self._version += 1
+    try:
+      body = json.dumps(status, sort_keys=True)
+    except UnicodeDecodeError:
+      # tags which aren't UTF-8
+      body = json.dumps(status, sort_keys=True, encoding='latin-1')
+    self._document = ('"%s-%d"' % (self._prefix, self._version), body)
+    os.write(self._wake[1], 'x')
+
+  def close(self):
+    if not self._stopped:
+      self._stopped = True
+      os.write(self._wake[1], 'x')
+      self._thread.join()
+      os.close(self._wake[1])
+
+  def _work(self):
+    try:
+      while not self._stopped:
+        self._step()
+    finally:
+      for client in self._clients.values():
+        client.sock.close()
+      self._sock.close()
+      os.close(self._wake[0])
+
+  def _step(self):
+    reading = [self._sock, self._wake[0]]
+    writing = []
+    deadline = None
+    for client in self._clients.values():
+      if client.response:
+        writing.append(client.sock)
+      elif client.etag is None:
+        reading.append(client.sock)
+      if deadline is None or client.deadline < deadline:
+        deadline = client.deadline
+    timeout = None
+    if deadline is not None:
+      timeout = max(0, deadline - time.time())
+    try:
+      readable, writable = select.select(reading, writing, [], timeout)[:2]
+    except select.error, e:
+      if e.args[0] == errno.EINTR:
+        return
+      raise
+    if self._wake[0] in readable:
+      os.read(self._wake[0], 4096)
+      self._answer_waiting()
+    if self._sock in readable:
+      self._accept()
+    for sock in readable:
+      if sock in self._clients:
+        self._receive(self._clients[sock])
+    for sock in writable:
+      if sock in self._clients:
+        self._send(self._clients[sock])
+    now = time.time()
+    for client in self._clients.values():
+      if client.deadline > now:
+        continue
+      if client.etag is None or client.response:
+        self._drop(client)
+      else:
+        # the long poll is over without change
+        self._respond(client, 304)
+
+  def _accept(self):
+    try:
+      sock = self._sock.accept()[0]
+    except socket.error:
+      return
+    sock.setblocking(0)
+    self._clients[sock] = Client(sock, time.time() + REQUEST_TIMEOUT)
+
+  def _drop(self, client):
+    del self._clients[client.sock]
+    client.sock.close()
+
+  def _receive(self, client):
+    try:
+      data = client.sock.recv(4096)
+    except socket.error, e:
+      if e.args[0] in (errno.EAGAIN, errno.EINTR):
+        return
+      data = ''
+    if not data:
+      self._drop(client)
+      return
+    client.request += data
+    if '\r\n\r\n' in client.request or '\n\n' in client.request:
+      self._handle(client)
+    elif len(client.request) > MAX_REQUEST:
+      self._respond(client, 400)
+
+  def _handle(self, client):
+    lines = client.request.replace('\r\n', '\n').split('\n')
+    try:
+      method, target = lines[0].split()[:2]
+    except ValueError:
+      self._respond(client, 400)
+      return
+    headers = {}
+    for line in lines[1:]:
+      name, sep, value = line.partition(':')
+      if sep:
+        headers[name.strip().lower()] = value.strip()
+    if method not in ('GET', 'HEAD'):
+      self._respond(client, 405)
+      return
+    client.head = method == 'HEAD'
+    url = urlparse.urlsplit(target)
+    if url.path not in ('/', '/status'):
+      self._respond(client, 404)
+      return
+    etag = self._document[0]
+    if headers.get('if-none-match') != etag:
+      self._respond(client, 200)
+      return
+    try:
+      wait = float(urlparse.parse_qs(url.query).get('wait', [0])[0])
+    except ValueError:
+      wait = 0
+    if wait > 0:
+      client.etag = etag
+      client.deadline = time.time() + min(wait, self.timeout)
+    else:
+      self._respond(client, 304)
+
+  def _answer_waiting(self):
+    etag = self._document[0]
+    for client in self._clients.values():
+      if client.etag is not None and client.etag != etag \
+        and not client.response:
+          self._respond(client, 200)
+
+  def _respond(self, client, code):
+    etag, body = self._document
+    headers = ['HTTP/1.1 %d %s' % (code, REASONS[code])]
+    if code in (200, 304):
+      headers += [
+        'ETag: ' + etag,
+        'Cache-Control: no-cache',
+        'Access-Control-Allow-Origin: *',
+        'Access-Control-Expose-Headers: ETag',
+      ]
+    if code == 200:
+      headers.append('Content-Type: application/json; charset=utf-8')
+    else:
+      body = ''
+    headers += ['Content-Length: %d' % len(body), 'Connection: close', '', '']
+    client.response = '\r\n'.join(headers)
+    if not client.head:
+      client.response += body
+    # slow readers get as long as a request may take
+    client.deadline = time.time() + REQUEST_TIMEOUT
+    self._send(client)
+
+  def _send(self, client):
+    try:
+      sent = client.sock.send(client.response)
+    except socket.error, e:
+      if e.args[0] in (errno.EAGAIN, errno.EINTR):
+        return
+      self._drop(client)
+      return
+    client.response = client.response[sent:]
+    if not client.response:
+      self._drop(client)
+
+# vim: set sw=2 et